@@ -0,0 +1,135 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from instrumentation import instruments, Verbosity
+from resultCache import ResultCache
+from syncPipeline import SyncPipeline, applyOffset
+
+def syncOneFile(videoSource, outputFile, scratchRoot, nonSpeechFilterLevel, cacheDirectory):
+    """Runs in a worker process. Syncs one file, with its intermediate files in a scratch directory of its own, and returns its manifest record."""
+    instruments.configure(verbosity=Verbosity.QUIET) #the batch reports progress per file instead
+    startTime = time.perf_counter()
+    scratchDirectory = tempfile.mkdtemp(prefix="syncJob-", dir=scratchRoot)
+    try:
+        cache = ResultCache(cacheDirectory) if cacheDirectory is not None else None
+        pipeline = SyncPipeline(videoSource, nonSpeechFilterLevel, numVideoWorkers=1, cache=cache, workingDirectory=scratchDirectory) #files are already spread across the worker processes
+        pipeline.run()
+        offset, confidence = pipeline.estimateOffset()
+        os.makedirs(os.path.dirname(outputFile) or ".", exist_ok=True)
+        if applyOffset(videoSource, offset, outputFile) != 0:
+            raise RuntimeError(f"ffmpeg could not write {outputFile}")
+        return {"status": "done", "offset": offset, "confidence": confidence, "output": outputFile, "seconds": time.perf_counter() - startTime}
+    finally:
+        shutil.rmtree(scratchDirectory, ignore_errors=True)
+
+class BatchSync:
+    """Syncs many video files across a pool of worker processes.
+    Every finished job is appended to a JSON lines manifest as soon as it completes, so an interrupted batch can be run again and only the files that have not finished (or have changed since) are processed.
+    """
+    def __init__(self, sources, outputDirectory, numWorkers=None, manifestFile=None, nonSpeechFilterLevel=1, cacheDirectory=None, scratchRoot=None) -> None:
+        self.sources = sources #video files and/or directories to search for video files
+        self.outputDirectory = outputDirectory
+        self.numWorkers = numWorkers or os.cpu_count() or 1
+        self.manifestFile = manifestFile or os.path.join(outputDirectory, "manifest.jsonl")
+        self.nonSpeechFilterLevel = nonSpeechFilterLevel
+        self.cacheDirectory = cacheDirectory #None disables the result cache
+        self.scratchRoot = scratchRoot #where per job scratch directories are created. None uses the system temporary directory
+        self.videoExtensions = (".mp4", ".mkv", ".mov", ".avi", ".webm")
+        self.outputSuffix = "_sync"
+
+    def findVideos(self):#returns [(videoFile, outputFile)], with outputs mirroring where each video is below the deepest directory shared by all sources, so that equally named files from different places don't collide
+        videoFiles = []
+        for source in self.sources:
+            if os.path.isdir(source):
+                for directory, subdirectories, fileNames in os.walk(source):
+                    subdirectories[:] = sorted(subdirectory for subdirectory in subdirectories if os.path.abspath(os.path.join(directory, subdirectory)) != os.path.abspath(self.outputDirectory)) #don't pick up synced files when the output directory is inside a source directory
+                    videoFiles.extend(os.path.join(directory, fileName) for fileName in sorted(fileNames) if fileName.lower().endswith(self.videoExtensions))
+            else:
+                videoFiles.append(source)
+        if not videoFiles:
+            return []
+        commonRoot = os.path.commonpath([os.path.abspath(source) if os.path.isdir(source) else os.path.dirname(os.path.abspath(source)) for source in self.sources])
+        jobs = []; seenFiles = set()
+        for videoFile in videoFiles:
+            absolutePath = os.path.abspath(videoFile)
+            if absolutePath in seenFiles:#a file given on its own as well as inside a given directory
+                continue
+            seenFiles.add(absolutePath)
+            jobs.append((videoFile, self.outputFileFor(os.path.relpath(absolutePath, commonRoot))))
+        return jobs
+
+    def outputFileFor(self, relativePath):
+        pathWithoutExtension, extension = os.path.splitext(relativePath)
+        return os.path.join(self.outputDirectory, pathWithoutExtension + self.outputSuffix + extension)
+
+    def jobIdentity(self, videoFile):#a file that has changed since it was synced is synced again
+        fileStatus = os.stat(videoFile)
+        return {"source": os.path.abspath(videoFile), "size": fileStatus.st_size, "modified": fileStatus.st_mtime_ns}
+
+    def readFinishedJobs(self):
+        finishedJobs = set()
+        if not os.path.exists(self.manifestFile):
+            return finishedJobs
+        with open(self.manifestFile) as manifest:
+            for line in manifest:
+                try:
+                    record = json.loads(line)
+                except ValueError:#a line cut short by an interruption
+                    continue
+                if record.get("status") == "done":
+                    finishedJobs.add((record["source"], record["size"], record["modified"]))
+        return finishedJobs
+
+    def findPendingJobs(self, finishedJobs):#returns [(identity, videoFile, outputFile)] for the videos not in finishedJobs
+        pendingJobs = []
+        for videoFile, outputFile in self.findVideos():
+            identity = self.jobIdentity(videoFile)
+            if (identity["source"], identity["size"], identity["modified"]) not in finishedJobs:
+                pendingJobs.append((identity, videoFile, outputFile))
+        return pendingJobs
+
+    def recordJob(self, record):
+        with open(self.manifestFile, 'a') as manifest:
+            manifest.write(json.dumps(record) + "\n")
+            manifest.flush()
+            os.fsync(manifest.fileno())
+
+    def run(self):
+        os.makedirs(self.outputDirectory, exist_ok=True)
+        os.makedirs(os.path.dirname(self.manifestFile) or ".", exist_ok=True)
+        finishedJobs = self.readFinishedJobs()
+        pendingJobs = self.findPendingJobs(finishedJobs)
+        numJobs = len(pendingJobs)
+        instruments.log(Verbosity.NORMAL, f"{numJobs} files to sync, {len(finishedJobs)} already done according to {self.manifestFile}")
+        numFailed = 0
+        with ProcessPoolExecutor(max_workers=self.numWorkers, mp_context=multiprocessing.get_context("spawn")) as executor:#spawned rather than forked, so that no worker starts out holding a lock copied from this process
+            futures = {executor.submit(syncOneFile, videoFile, outputFile, self.scratchRoot, self.nonSpeechFilterLevel, self.cacheDirectory): identity for identity, videoFile, outputFile in pendingJobs}
+            for jobNumber, future in enumerate(as_completed(futures), start=1):
+                record = dict(futures[future])
+                try:
+                    record.update(future.result())
+                except Exception as e:#a failed file is recorded and retried on the next run, without stopping the others
+                    record.update({"status": "failed", "error": repr(e)})
+                    numFailed = numFailed + 1
+                self.recordJob(record)
+                instruments.log(Verbosity.NORMAL, f"[{jobNumber}/{numJobs}] {record['status']}: {record['source']}")
+        instruments.log(Verbosity.QUIET, f"Batch complete. {numJobs - numFailed} synced, {numFailed} failed.")
+        return numFailed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sync the audio and video of many files")
+    parser.add_argument("sources", nargs="+", help="video files and/or directories containing video files")
+    parser.add_argument("--output", required=True, help="directory for the synced files and the manifest")
+    parser.add_argument("--workers", type=int, default=None, help="number of files synced at the same time (default: number of CPUs)")
+    parser.add_argument("--manifest", default=None, help="JSON lines progress manifest (default: <output>/manifest.jsonl)")
+    parser.add_argument("--filter-level", type=int, default=1, choices=range(4), help="VAD aggressiveness about filtering out non-speech")
+    parser.add_argument("--cache", default=None, help="result cache directory (default: no cache)")
+    parser.add_argument("--scratch", default=None, help="directory for per job scratch directories")
+    arguments = parser.parse_args()
+    batch = BatchSync(arguments.sources, arguments.output, arguments.workers, arguments.manifest, arguments.filter_level, arguments.cache, arguments.scratch)
+    raise SystemExit(1 if batch.run() else 0)
@@ -0,0 +1,213 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+from faceDetector import LandmarkStore, VideoFaceProcessor
+from offsetEstimator import OffsetEstimator
+from syncPipeline import findSpeechStarts
+from voiceActivityDetection import AudioProcessor, Speech, SpeechStore, VoiceActivityDetector
+
+class SyntheticFixture:
+    """Deterministic synthetic input of a given length: alternating speech and silence, as 16-bit mono PCM and as a landmark sequence whose lip movement follows the same speech pattern, delayed by injectedOffset seconds."""
+    def __init__(self, durationSeconds, seed=0, sampleRate=16000, fps=30, injectedOffset=0.4) -> None:
+        self.durationSeconds = durationSeconds
+        self.sampleRate = sampleRate
+        self.fps = fps
+        self.injectedOffset = injectedOffset #video timestamp minus audio timestamp of the same speech
+        self.randomGenerator = np.random.default_rng(seed)
+        self.speechSegments = self.synthesizeSpeechSegments() #[(startSeconds, endSeconds)] of speech, in the audio timeline
+        self.pcm = self.synthesizePcm()
+        self.landmarks = None #built on first use, since it needs a VideoFaceProcessor for the point codes
+
+    def synthesizeSpeechSegments(self):
+        segments = []
+        timestamp = self.randomGenerator.uniform(0.5, 2.0)
+        while timestamp < self.durationSeconds:
+            speechDuration = self.randomGenerator.uniform(1.0, 6.0); pauseDuration = self.randomGenerator.uniform(0.6, 3.0)
+            segments.append((timestamp, min(timestamp + speechDuration, self.durationSeconds)))
+            timestamp = timestamp + speechDuration + pauseDuration
+        return segments
+
+    def isSpeech(self, timestamps):#bool array, True where timestamps fall inside a speech segment
+        speaking = np.zeros(len(timestamps), dtype=bool)
+        for startSeconds, endSeconds in self.speechSegments:
+            speaking[(timestamps >= startSeconds) & (timestamps < endSeconds)] = True
+        return speaking
+
+    def synthesizePcm(self):
+        #---speech is a harmonic voice-like tone with a syllable rate envelope, silence is faint noise
+        timestamps = np.arange(int(self.durationSeconds * self.sampleRate)) / self.sampleRate
+        fundamental = 140
+        voice = sum(np.sin(2 * np.pi * fundamental * harmonic * timestamps) / harmonic for harmonic in range(1, 8))
+        syllableEnvelope = 0.6 + 0.4 * np.abs(np.sin(2 * np.pi * 2 * timestamps)) #about 4 syllables per second
+        signal = np.where(self.isSpeech(timestamps), 4000 * voice * syllableEnvelope, 0)
+        signal = signal + self.randomGenerator.normal(0, 30, len(timestamps))
+        return np.clip(signal, -32768, 32767).astype('<i2').tobytes()
+
+    def getLandmarks(self, faceProcessor):
+        if self.landmarks is None:
+            self.landmarks = self.synthesizeLandmarks(faceProcessor)
+        return self.landmarks
+
+    def synthesizeLandmarks(self, faceProcessor):
+        timestamps = np.arange(1, int(self.durationSeconds * self.fps) + 1) / self.fps
+        speaking = self.isSpeech(timestamps - self.injectedOffset)
+        lipSeparationPercent = np.where(speaking, 2 + 4 * np.abs(np.sin(2 * np.pi * 2 * timestamps)), 0.3) + self.randomGenerator.normal(0, 0.1, len(timestamps))
+        points = np.zeros((len(timestamps), len(faceProcessor.pointCodes), 3), dtype=np.float32)
+        faceHeight = 0.6
+        for column, pointCode in enumerate(faceProcessor.pointCodes):
+            points[:, column, 0] = 0.5
+            if pointCode == faceProcessor.topOfHead:
+                points[:, column, 1] = 0.2
+            elif pointCode == faceProcessor.tipOfChin:
+                points[:, column, 1] = 0.2 + faceHeight
+            elif pointCode in faceProcessor.upperLipPoints:
+                points[:, column, 1] = 0.6
+            else:
+                points[:, column, 1] = 0.6 + faceHeight * np.maximum(lipSeparationPercent, 0) / 100
+        return LandmarkStore.fromArrays(faceProcessor.pointCodes, timestamps, points)
+
+class Benchmark:
+    """Times each stage of the pipeline on synthetic fixtures of several lengths, recording throughput and peak (Python heap) memory."""
+    def __init__(self, durations, repeat=3, seed=0) -> None:
+        self.durations = durations #seconds of synthetic media per fixture
+        self.repeat = repeat #timed runs per stage; the fastest is reported
+        self.seed = seed
+        self.frameDurationMs = 30
+        self.stages = {"frame_generator": self.benchFrameGenerator, "stream_frame_generator": self.benchStreamFrameGenerator, "detectSpeech": self.benchDetectSpeech,
+                       "calculateLipMovement": self.benchCalculateLipMovement, "determineSilencePhases": self.benchDetermineSilencePhases,
+                       "findSpeechStarts": self.benchFindSpeechStarts, "offsetEstimation": self.benchOffsetEstimation}
+
+    def run(self, stageNames=None):
+        results = []
+        for durationSeconds in self.durations:
+            fixture = SyntheticFixture(durationSeconds, self.seed)
+            for stageName, stage in self.stages.items():
+                if stageNames and stageName not in stageNames:
+                    continue
+                result = self.measure(stage, fixture)
+                result.update({"stage": stageName, "durationSeconds": durationSeconds})
+                print(f"{stageName:>24} {durationSeconds:>6}s: {result['seconds']:.4f}s, {result['itemsPerSecond']:.0f} {result['unit']}/s, peak {result['peakBytes'] / 1024**2:.1f} MiB")
+                results.append(result)
+        return results
+
+    def measure(self, stage, fixture):
+        #---stages are called as stage(fixture) -> (workToTime, numberOfItems, unit, extraResults). Time and memory are measured on separate runs, since tracing allocations slows things down
+        bestSeconds = None
+        for _ in range(self.repeat):
+            work, numItems, unit, extraResults = stage(fixture)
+            with contextlib.redirect_stdout(io.StringIO()):#keeps any console output of the stage out of the timings
+                startTime = time.perf_counter()
+                work()
+                seconds = time.perf_counter() - startTime
+            bestSeconds = seconds if bestSeconds is None else min(bestSeconds, seconds)
+        work, numItems, unit, extraResults = stage(fixture)
+        tracemalloc.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            work()
+        currentBytes, peakBytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result = {"seconds": bestSeconds, "items": numItems, "unit": unit, "itemsPerSecond": numItems / bestSeconds if bestSeconds > 0 else float("inf"), "peakBytes": peakBytes}
+        result.update(extraResults)
+        return result
+
+    def audioFrames(self, fixture):
+        return list(AudioProcessor().frame_generator(self.frameDurationMs, fixture.pcm, fixture.sampleRate))
+
+    def speechMarkers(self, fixture):
+        timestamps = np.arange(0, fixture.durationSeconds, self.frameDurationMs / 1000)
+        return [Speech(timestamp, speaking) for timestamp, speaking in zip(timestamps.tolist(), fixture.isSpeech(timestamps).tolist())]
+
+    def faceProcessor(self, fixture):
+        faceProcessor = VideoFaceProcessor(None)
+        faceProcessor.fps = fixture.fps
+        faceProcessor.pauseDuration = int((7/30) * fixture.fps)
+        return faceProcessor
+
+    def benchFrameGenerator(self, fixture):
+        numFrames = len(fixture.pcm) // int(fixture.sampleRate * self.frameDurationMs / 1000 * 2)
+        return lambda: list(AudioProcessor().frame_generator(self.frameDurationMs, fixture.pcm, fixture.sampleRate)), numFrames, "frames", {}
+
+    def benchStreamFrameGenerator(self, fixture):
+        numFrames = len(fixture.pcm) // int(fixture.sampleRate * self.frameDurationMs / 1000 * 2)
+        def work():
+            for frame in AudioProcessor().stream_frame_generator(self.frameDurationMs, io.BytesIO(fixture.pcm), fixture.sampleRate):
+                pass
+        return work, numFrames, "frames", {}
+
+    def benchDetectSpeech(self, fixture):#the VAD pass the pipeline runs, at one level
+        frames = self.audioFrames(fixture)
+        detector = VoiceActivityDetector()
+        def work():
+            detector.speechByLevel = {1: SpeechStore()}
+            detector.detectSpeech(frames, fixture.sampleRate, [1])
+        return work, len(frames), "frames", {}
+
+    def benchCalculateLipMovement(self, fixture):
+        faceProcessor = self.faceProcessor(fixture)
+        landmarks = fixture.getLandmarks(faceProcessor)
+        faceProcessor.faces[faceProcessor.hardCodedFaceID] = landmarks
+        return faceProcessor.calculateLipMovement, len(landmarks), "frames", {}
+
+    def benchDetermineSilencePhases(self, fixture):
+        faceProcessor = self.faceProcessor(fixture)
+        landmarks = fixture.getLandmarks(faceProcessor)
+        with contextlib.redirect_stdout(io.StringIO()):
+            faceProcessor.analyseLipMovement(landmarks)
+        return lambda: faceProcessor.determineSilencePhases(landmarks), len(landmarks), "frames", {}
+
+    def benchFindSpeechStarts(self, fixture):
+        markers = self.speechMarkers(fixture)
+        return lambda: findSpeechStarts(markers, 15), len(markers), "frames", {}
+
+    def benchOffsetEstimation(self, fixture):
+        markers = self.speechMarkers(fixture)
+        faceProcessor = self.faceProcessor(fixture)
+        landmarks = fixture.getLandmarks(faceProcessor)
+        with contextlib.redirect_stdout(io.StringIO()):
+            faceProcessor.analyseLipMovement(landmarks)
+        audioTimestamps = [speech.timestamp for speech in markers]; audioSpeaking = [speech.speaking for speech in markers]
+        estimator = OffsetEstimator()
+        offset, confidence = estimator.estimate(audioTimestamps, audioSpeaking, landmarks.timestamps, landmarks.lipSeparation)
+        accuracy = {"estimatedOffset": offset, "injectedOffset": fixture.injectedOffset, "offsetError": abs(offset - fixture.injectedOffset), "confidence": confidence}
+        return lambda: estimator.estimate(audioTimestamps, audioSpeaking, landmarks.timestamps, landmarks.lipSeparation), len(markers) + len(landmarks), "samples", accuracy
+
+def describeEnvironment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {"commit": commit, "python": sys.version.split()[0], "numpy": np.__version__, "machine": platform.machine(), "processor": platform.processor(), "cpus": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S%z")}
+
+def compareResults(previousResults, currentResults):#prints how each stage's time changed relative to an earlier results file
+    previousSeconds = {(result["stage"], result["durationSeconds"]): result["seconds"] for result in previousResults}
+    print("Compared to the previous run (ratio < 1 is faster):")
+    for result in currentResults:
+        key = (result["stage"], result["durationSeconds"])
+        if key in previousSeconds and previousSeconds[key] > 0:
+            print(f"{result['stage']:>24} {result['durationSeconds']:>6}s: {result['seconds'] / previousSeconds[key]:.2f}x")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on deterministic synthetic audio and landmark fixtures")
+    parser.add_argument("--durations", type=float, nargs="+", default=[60, 600], help="seconds of synthetic media to benchmark with")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage (the fastest is reported)")
+    parser.add_argument("--stages", nargs="+", default=None, help="only run these stages")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="write the results as JSON to this file")
+    parser.add_argument("--compare", default=None, help="an earlier results file to compare against")
+    arguments = parser.parse_args()
+    benchmark = Benchmark(arguments.durations, arguments.repeat, arguments.seed)
+    results = benchmark.run(arguments.stages)
+    if arguments.output:
+        with open(arguments.output, 'w') as outputFile:
+            json.dump({"environment": describeEnvironment(), "results": results}, outputFile, indent=2)
+    if arguments.compare:
+        with open(arguments.compare) as previousFile:
+            compareResults(json.load(previousFile)["results"], results)
@@ -1,15 +1,19 @@
+import contextlib
 import math
+import multiprocessing
+import os
 import cv2
+import numpy as np
 import mediapipe as mp
 import time
-from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from instrumentation import instruments, Verbosity
+from lipTracker import LipTracker
+from videoDecoder import OpenCvDecoder, FfmpegDecoder
 
 mediaPipeDraw = mp.solutions.drawing_utils
 mediaPipeFaceMesh = mp.solutions.face_mesh
 
-class Const:
-    MILLISECONDS_IN_ONE_SECOND = 1000
-
 class Landmark:
     def __init__(self, timestamp) -> None:
         self.timestamp = timestamp
@@ -23,8 +27,91 @@ class Landmark:
     def storeLipSeparation(self, normalizedAbsoluteDistance):
         self.lipSeparation = normalizedAbsoluteDistance
 
+class LandmarkStore:
+    """Columnar store of the tracked face points of consecutive frames: one float32 array of shape (frames, points, 3) plus a timestamps array.
+    Iterating or indexing it gives Landmark objects, for code that still works with those.
+    """
+    def __init__(self, pointCodes, capacity=1024) -> None:
+        self.pointCodes = list(pointCodes)
+        self.pointIndex = {pointCode: i for i, pointCode in enumerate(self.pointCodes)} #{pointCode: column in self.points}
+        self.numFrames = 0
+        self.allPoints = np.zeros((capacity, len(self.pointCodes), 3), dtype=np.float32) #grows by doubling as frames are appended
+        self.allTimestamps = np.zeros(capacity, dtype=np.float64)
+        self.lipSeparation = None #float array with one value per frame, once calculated
+        self.speaking = None #bool array with one value per frame, once calculated
+
+    @classmethod
+    def fromArrays(cls, pointCodes, timestamps, points):
+        landmarks = cls(pointCodes, capacity=max(1, len(timestamps)))
+        landmarks.numFrames = len(timestamps)
+        landmarks.allTimestamps[:landmarks.numFrames] = timestamps
+        landmarks.allPoints[:landmarks.numFrames] = points
+        return landmarks
+
+    @property
+    def points(self):
+        return self.allPoints[:self.numFrames]
+
+    @property
+    def timestamps(self):
+        return self.allTimestamps[:self.numFrames]
+
+    def append(self, timestamp, xyzOfPoints):#xyzOfPoints holds one [x, y, z] per point code, in the order of self.pointCodes
+        if self.numFrames == len(self.allTimestamps):
+            self.reserve(max(1, 2 * self.numFrames))
+        self.allPoints[self.numFrames] = xyzOfPoints
+        self.allTimestamps[self.numFrames] = timestamp
+        self.numFrames = self.numFrames + 1
+
+    def extend(self, otherStore):
+        if self.lipSeparation is not None and otherStore.lipSeparation is not None and len(self.lipSeparation) == self.numFrames:
+            self.lipSeparation = np.concatenate((self.lipSeparation, otherStore.lipSeparation))
+            self.speaking = np.concatenate((self.speaking, otherStore.speaking))
+        elif self.numFrames == 0:#results already calculated for the other store carry over
+            self.lipSeparation = otherStore.lipSeparation; self.speaking = otherStore.speaking
+        else:
+            self.lipSeparation = None; self.speaking = None
+        self.reserve(self.numFrames + otherStore.numFrames)
+        self.allPoints[self.numFrames:self.numFrames + otherStore.numFrames] = otherStore.points
+        self.allTimestamps[self.numFrames:self.numFrames + otherStore.numFrames] = otherStore.timestamps
+        self.numFrames = self.numFrames + otherStore.numFrames
+
+    def reserve(self, capacity):
+        if capacity <= len(self.allTimestamps):
+            return
+        allPoints = np.zeros((capacity, len(self.pointCodes), 3), dtype=np.float32)
+        allPoints[:self.numFrames] = self.points
+        allTimestamps = np.zeros(capacity, dtype=np.float64)
+        allTimestamps[:self.numFrames] = self.timestamps
+        self.allPoints = allPoints; self.allTimestamps = allTimestamps
+
+    def pointColumns(self, pointCodes):
+        return [self.pointIndex[pointCode] for pointCode in pointCodes]
+
+    def __len__(self):
+        return self.numFrames
+
+    def __getitem__(self, frameIndex):
+        if frameIndex < 0:
+            frameIndex = frameIndex + self.numFrames
+        if not 0 <= frameIndex < self.numFrames:
+            raise IndexError("frame index out of range")
+        landmarkObject = Landmark(float(self.allTimestamps[frameIndex]))
+        for pointCode, column in self.pointIndex.items():
+            x, y, z = self.allPoints[frameIndex, column]
+            landmarkObject.setPoint(pointCode, float(x), float(y), float(z))
+        if self.lipSeparation is not None:
+            landmarkObject.storeLipSeparation(float(self.lipSeparation[frameIndex]))
+        if self.speaking is not None:
+            landmarkObject.speaking = bool(self.speaking[frameIndex])
+        return landmarkObject
+
+    def __iter__(self):
+        for frameIndex in range(self.numFrames):
+            yield self[frameIndex]
+
 class VideoFaceProcessor:
-    def __init__(self, videoSource, displayMesh=False) -> None:
+    def __init__(self, videoSource, displayMesh=False, numWorkers=1, cache=None) -> None:
         self.drawSettings = mediaPipeDraw.DrawingSpec(thickness=1, circle_radius=1)
         self.videoSource = videoSource
         self.displayMesh = displayMesh
@@ -34,7 +121,8 @@ class VideoFaceProcessor:
         self.tipOfChin = 152
         self.upperLipPoints = [82, 13, 312] #these are the canonical face model points that will be used to compare distance with the corresponding lower lip points
         self.lowerLipPoints = [87, 14, 317] #these points will be compared with the upper lip points (these point ID's are available here https://github.com/google/mediapipe/issues/1615)
-        self.faces = {} #{faceID: deque[Landmark instance1, Landmark instance2, ...]}
+        self.pointCodes = [self.topOfHead, self.tipOfChin] + self.upperLipPoints + self.lowerLipPoints #the only points of the face mesh that are stored
+        self.faces = {} #{faceID: LandmarkStore}
         self.hardCodedFaceID = "face1" #TODO: face detection needs to be more generic before being able to assign a faceID to the self.faces dict
         self.fps = None
         self.fontDisplayPosition = (10, 30)
@@ -42,46 +130,232 @@ class VideoFaceProcessor:
         self.fontColor = (0, 255, 0)
         self.fontThickness = 2      
         self.pauseDuration = None
+        self.numWorkers = numWorkers #number of processes used to run the face mesh. 1 processes the whole video serially
+        self.rangeOverlapSeconds = 1 #each parallel range starts this much earlier, so that the face mesh tracking has warmed up by the start of the range
+        self.minimumRangeLength = 5 #parallel ranges are at least this many times rangeOverlapSeconds long, so that warm-up frames stay a small part of what the workers decode. Shorter videos use fewer workers
+        self.cache = cache #a ResultCache that landmarks are loaded from instead of running the face mesh, if they were cached before with the same parameters
+        self.mouthOpeningThreshold = 1 #distance of lip separation
+        self.keyframeInterval = 1 #run the face mesh on at most every this many frames, and track the lip points by optical flow in between. 1 runs the face mesh on every frame
+        self.decodeBackend = "opencv" #"ffmpeg" decodes through an ffmpeg pipe at analysisWidth and analysisFps, "opencv" through cv2.VideoCapture at full size
+        self.analysisFps = None #with the ffmpeg backend, the frame rate the face mesh sees (None keeps the video's). Lip movement doesn't need more than about 15-30FPS
+        self.analysisWidth = None #with the ffmpeg backend, the width frames are scaled down to (None keeps the video's)
+        self.faceMesh = None #an already built FaceMesh to use instead of building one per frame range, e.g. one kept warm by a long running service. It must not be used by two threads at once
+        self.lipSeparationTolerance = 0.3 #with keyframeInterval > 1, keyframes come more often while tracking drifts further than this from the face mesh lip separation
 
     def run(self):
-        videoHandle = cv2.VideoCapture(self.videoSource)
-        self.fps = videoHandle.get(cv2.CAP_PROP_FPS)
-        self.pauseDuration = int((7/30) * self.fps) #because during an experiment it was seen that in a 30FPS video, if 7 consecutive frames were with mouth shut, it could be a pause
-        print(f"Video has {self.fps}FPS and pause detection duration = {self.pauseDuration} frames Processing...")
-        frameNumber = 0
-        with mediaPipeFaceMesh.FaceMesh(min_detection_confidence=self.minimumDetectionConfidence, min_tracking_confidence=self.minimumTrackingConfidence) as detectedMesh:
-            while videoHandle.isOpened():#as long as there are frames
-                frameExists, theImage = videoHandle.read()
-                if not frameExists:#reached end of video
-                    break #for a stream, you'd use `continue` here
-                #---preprocess
-                theImage = cv2.cvtColor(theImage, cv2.COLOR_BGR2RGB)
-                theImage.flags.writeable = False #a performance improvement (optional)
-                processedImage = detectedMesh.process(theImage)
-                #---Extract desired points
-                theImage.flags.writeable = True                
-                theImage = cv2.cvtColor(theImage, cv2.COLOR_RGB2BGR)
-                if self.displayMesh:
-                    self.displayVideo(theImage, f'FPS: {int(self.fps)}')
-                timestamp = videoHandle.get(cv2.CAP_PROP_POS_MSEC) / Const.MILLISECONDS_IN_ONE_SECOND
-                print(f"Frame {frameNumber}, timestamp {timestamp}")
-                if processedImage.multi_face_landmarks:
-                    for detectedFace in processedImage.multi_face_landmarks:
-                        if self.hardCodedFaceID not in self.faces:#face not present in dict
-                            self.faces[self.hardCodedFaceID] = deque() #add new face
-                        if self.displayMesh:
-                            mediaPipeDraw.draw_landmarks(image=theImage, landmark_list=detectedFace, connections=mediaPipeFaceMesh.FACEMESH_CONTOURS, landmark_drawing_spec=self.drawSettings, connection_drawing_spec=self.drawSettings)
-                        pointIterator = 0
-                        landmarkObject = Landmark(timestamp)
-                        for pointOnFace in detectedFace.landmark:
-                            if pointIterator in self.upperLipPoints or pointIterator in self.lowerLipPoints or pointIterator == self.topOfHead or pointIterator == self.tipOfChin:
-                                landmarkObject.setPoint(pointIterator, pointOnFace.x, pointOnFace.y, pointOnFace.z)
-                            pointIterator = pointIterator + 1  
-                        self.faces[self.hardCodedFaceID].append(landmarkObject)
-                frameNumber = frameNumber + 1                
-            videoHandle.release            
+        numFrames = self.readVideoProperties()
+        landmarkRanges = self.loadCachedLandmarks(None)
+        if landmarkRanges is None:
+            if self.numWorkers > 1 and not self.displayMesh:#the mesh can't be displayed from worker processes
+                frameRanges = self.splitIntoFrameRanges(numFrames)
+            else:
+                frameRanges = [(0, None)]
+            landmarkRanges = self.processFrameRanges(frameRanges)
+        landmarks = LandmarkStore(self.pointCodes)
+        for rangeLandmarks in landmarkRanges:#ranges are in frame order, so concatenating them keeps the landmarks in timestamp order
+            landmarks.extend(rangeLandmarks)
+        self.saveCachedLandmarks(None, [landmarks])
+        if len(landmarks):
+            self.faces[self.hardCodedFaceID] = landmarks
         #print(f"Finished processing. {len(self.faces[self.hardCodedFaceID])} landmark objects added for face {self.hardCodedFaceID}")
         self.calculateLipMovement()
+
+    def runOnTimeRanges(self, timeRanges):
+        """Like run(), but only landmarks the frames inside the given [startSeconds, endSeconds] ranges. Overlapping ranges are merged.
+        Lip movement and silences are worked out separately for each range, since frames on either side of a gap between ranges are not consecutive.
+        """
+        numFrames = self.readVideoProperties()
+        frameRanges = []
+        for startSeconds, endSeconds in sorted(timeRanges):
+            startFrame = max(0, int(startSeconds * self.fps)); endFrame = min(numFrames, int(math.ceil(endSeconds * self.fps)))
+            if endFrame <= startFrame:
+                continue
+            if frameRanges and startFrame <= frameRanges[-1][1]:#overlaps or touches the previous range
+                frameRanges[-1] = (frameRanges[-1][0], max(frameRanges[-1][1], endFrame))
+            else:
+                frameRanges.append((startFrame, endFrame))
+        instruments.log(Verbosity.NORMAL, f"Landmarking {sum(end - start for start, end in frameRanges)} of {numFrames} frames in {len(frameRanges)} ranges")
+        landmarks = LandmarkStore(self.pointCodes)
+        landmarkRanges = self.loadCachedLandmarks(frameRanges)
+        if landmarkRanges is None:
+            landmarkRanges = self.processFrameRanges(frameRanges)
+            self.saveCachedLandmarks(frameRanges, landmarkRanges)
+        for rangeLandmarks in landmarkRanges:
+            if len(rangeLandmarks):
+                self.analyseLipMovement(rangeLandmarks)
+                landmarks.extend(rangeLandmarks)
+        if len(landmarks):
+            self.faces[self.hardCodedFaceID] = landmarks
+
+    def createDecoder(self):
+        if self.decodeBackend == "ffmpeg":
+            return FfmpegDecoder(self.videoSource, self.analysisFps, self.analysisWidth)
+        return OpenCvDecoder(self.videoSource)
+
+    def readVideoProperties(self):#self.fps is the frame rate of the frames analysed, which the ffmpeg backend can make lower than the video's
+        fps, numFrames = self.createDecoder().readProperties()
+        self.setFrameRate(fps)
+        instruments.log(Verbosity.NORMAL, f"Video has {self.fps}FPS and pause detection duration = {self.pauseDuration} frames Processing...")
+        return numFrames
+
+    def setFrameRate(self, fps):
+        self.fps = fps
+        self.pauseDuration = int((7/30) * self.fps) #because during an experiment it was seen that in a 30FPS video, if 7 consecutive frames were with mouth shut, it could be a pause
+
+    def processFrameRange(self, startFrame, endFrame, warmupFrames=0):
+        """Runs the face mesh on frames [startFrame, endFrame) and returns a LandmarkStore of the faces found, in frame order.
+        endFrame=None means until the end of the video. The mesh also sees warmupFrames frames before startFrame so that its tracking has settled by startFrame, but no landmarks are returned for those frames.
+        """
+        landmarks = LandmarkStore(self.pointCodes)
+        firstFrame = max(0, startFrame - warmupFrames)
+        decoder = self.createDecoder()
+        decoder.open(firstFrame, endFrame)
+        tracker = self.createLipTracker()
+        #---frames stay in the decoder's channel order, and are converted only to what each use needs: RGB for the face mesh, grey for tracking, BGR for display
+        isRgb = decoder.channelOrder == "RGB"
+        greyConversion = cv2.COLOR_RGB2GRAY if isRgb else cv2.COLOR_BGR2GRAY
+        try:
+            with self.openFaceMesh() as detectedMesh:
+                while True:#as long as there are frames
+                    frameExists, theImage, timestamp, frameNumber = decoder.read()
+                    if not frameExists:#reached end of video
+                        break #for a stream, you'd use `continue` here
+                    if endFrame is not None and frameNumber >= endFrame:#reached end of the range
+                        break
+                    instruments.count("framesDecoded")
+                    #---between keyframes, the points are tracked instead of running the face mesh
+                    trackedPoints = None
+                    if tracker is not None:
+                        with instruments.timer("colourConversion"):
+                            greyImage = cv2.cvtColor(theImage, greyConversion)
+                        if tracker.previousPoints is not None:#also tried on keyframes, to check the tracking against the face mesh
+                            with instruments.timer("lipTracking"):
+                                trackedPoints = tracker.track(greyImage)
+                            if trackedPoints is None:
+                                instruments.count("trackingLost")
+                        if trackedPoints is not None and not tracker.needsKeyframe():
+                            if frameNumber >= startFrame:
+                                landmarks.append(timestamp, trackedPoints)
+                                instruments.count("framesTracked")
+                            else:
+                                instruments.count("warmupFrames")
+                            continue
+                    if isRgb:
+                        rgbImage = theImage
+                    else:
+                        with instruments.timer("colourConversion"):
+                            rgbImage = cv2.cvtColor(theImage, cv2.COLOR_BGR2RGB)
+                    rgbImage.flags.writeable = False #a performance improvement (optional)
+                    with instruments.timer("faceMesh"):
+                        processedImage = detectedMesh.process(rgbImage)
+                    instruments.count("faceMeshFrames")
+                    #---Extract desired points
+                    if self.displayMesh:
+                        if isRgb:
+                            with instruments.timer("colourConversion"):
+                                theImage = cv2.cvtColor(theImage, cv2.COLOR_RGB2BGR)
+                        self.displayVideo(theImage, f'FPS: {int(self.fps)}')
+                    if tracker is not None:
+                        if processedImage.multi_face_landmarks:#tracking continues from the first face, which is the one analysed
+                            tracker.startFrom(greyImage, self.extractPoints(processedImage.multi_face_landmarks[0]), trackedPoints)
+                        else:
+                            tracker.reset()
+                    if frameNumber >= startFrame:#frames before startFrame only warm up the tracking
+                        if instruments.isEnabled(Verbosity.DEBUG):
+                            instruments.log(Verbosity.DEBUG, f"Frame {frameNumber}, timestamp {timestamp}")
+                        if processedImage.multi_face_landmarks:
+                            for detectedFace in processedImage.multi_face_landmarks:
+                                if self.displayMesh:
+                                    mediaPipeDraw.draw_landmarks(image=theImage, landmark_list=detectedFace, connections=mediaPipeFaceMesh.FACEMESH_CONTOURS, landmark_drawing_spec=self.drawSettings, connection_drawing_spec=self.drawSettings)
+                                with instruments.timer("landmarkExtraction"):
+                                    landmarks.append(timestamp, self.extractPoints(detectedFace))
+                                instruments.count("facesDetected")
+                    else:
+                        instruments.count("warmupFrames")
+        finally:
+            decoder.release()
+        return landmarks
+
+    def openFaceMesh(self):#a context manager giving the face mesh to use. A shared self.faceMesh is left open for the next video
+        if self.faceMesh is not None:
+            return contextlib.nullcontext(self.faceMesh)
+        return mediaPipeFaceMesh.FaceMesh(min_detection_confidence=self.minimumDetectionConfidence, min_tracking_confidence=self.minimumTrackingConfidence)
+
+    def createLipTracker(self):#None when every frame goes through the face mesh (which it does while the mesh is displayed)
+        if self.keyframeInterval <= 1 or self.displayMesh:
+            return None
+        headColumns = [self.pointCodes.index(self.topOfHead), self.pointCodes.index(self.tipOfChin)]
+        return LipTracker(headColumns, [self.pointCodes.index(pointCode) for pointCode in self.upperLipPoints], [self.pointCodes.index(pointCode) for pointCode in self.lowerLipPoints], self.keyframeInterval, self.lipSeparationTolerance)
+
+    def workerSettings(self):#the settings a worker process's VideoFaceProcessor takes over from this one
+        settingNames = ["fps", "minimumDetectionConfidence", "minimumTrackingConfidence", "keyframeInterval", "lipSeparationTolerance", "decodeBackend", "analysisFps", "analysisWidth"]
+        return {settingName: getattr(self, settingName) for settingName in settingNames}
+
+    def extractPoints(self, detectedFace):
+        return [[pointOnFace.x, pointOnFace.y, pointOnFace.z] for pointOnFace in (detectedFace.landmark[pointCode] for pointCode in self.pointCodes)]
+
+    def landmarkCacheKey(self, frameRanges):#frameRanges=None stands for the whole video
+        parameters = {"minimumDetectionConfidence": self.minimumDetectionConfidence, "minimumTrackingConfidence": self.minimumTrackingConfidence, "pointCodes": self.pointCodes}
+        if self.decodeBackend != "opencv":
+            parameters.update(decodeBackend=self.decodeBackend, analysisFps=self.analysisFps, analysisWidth=self.analysisWidth)
+        if self.keyframeInterval > 1:
+            parameters["keyframeInterval"] = self.keyframeInterval; parameters["lipSeparationTolerance"] = self.lipSeparationTolerance
+        if frameRanges is not None:
+            parameters["frameRanges"] = frameRanges; parameters["rangeOverlapSeconds"] = self.rangeOverlapSeconds
+        return self.cache.key(self.videoSource, "landmarks", parameters)
+
+    def loadCachedLandmarks(self, frameRanges):
+        """Returns the list of per range LandmarkStores cached for these frame ranges, or None if caching is off or nothing is cached yet.
+        Only the face mesh output is cached, so lip separation and silences are always recalculated with the current settings.
+        """
+        if self.cache is None:
+            return None
+        arrays = self.cache.load(self.landmarkCacheKey(frameRanges), ("timestamps", "points", "rangeLengths"))
+        if arrays is None:
+            return None
+        instruments.log(Verbosity.NORMAL, f"Loaded {len(arrays['timestamps'])} cached landmarks")
+        instruments.count("cachedLandmarksLoaded", len(arrays['timestamps']))
+        landmarkRanges = []
+        rangeEnds = np.cumsum(arrays["rangeLengths"])
+        for rangeStart, rangeEnd in zip(rangeEnds - arrays["rangeLengths"], rangeEnds):
+            landmarkRanges.append(LandmarkStore.fromArrays(self.pointCodes, arrays["timestamps"][rangeStart:rangeEnd], arrays["points"][rangeStart:rangeEnd]))
+        return landmarkRanges
+
+    def saveCachedLandmarks(self, frameRanges, landmarkRanges):
+        if self.cache is None or not landmarkRanges:
+            return
+        key = self.landmarkCacheKey(frameRanges)
+        if os.path.exists(self.cache.entryPath(key)):
+            return
+        self.cache.save(key, timestamps=np.concatenate([landmarks.timestamps for landmarks in landmarkRanges]), points=np.concatenate([landmarks.points for landmarks in landmarkRanges]), rangeLengths=np.array([len(landmarks) for landmarks in landmarkRanges], dtype=np.int64))
+
+    def splitIntoFrameRanges(self, numFrames):
+        """Splits the video into contiguous frame ranges, one per worker but none shorter than minimumRangeLength * rangeOverlapSeconds. The last range runs until the end of the video, since the frame count reported by the container can be approximate.
+        Each range's face mesh starts with its own tracking state, so the landmarks near a range start are close to, but not always identical with, those of a serial pass.
+        """
+        minimumRangeFrames = max(1, int(self.minimumRangeLength * self.rangeOverlapSeconds * self.fps))
+        numRanges = max(1, min(self.numWorkers, numFrames // minimumRangeFrames))
+        rangeLength = max(1, math.ceil(numFrames / numRanges))
+        startFrames = list(range(0, max(numFrames, 1), rangeLength))
+        endFrames = startFrames[1:] + [None]
+        return list(zip(startFrames, endFrames))
+
+    def processFrameRanges(self, frameRanges):
+        """Returns one LandmarkStore per (startFrame, endFrame) range, in the order of frameRanges. Uses a process pool when numWorkers > 1."""
+        warmupFrames = int(self.rangeOverlapSeconds * self.fps)
+        if self.numWorkers <= 1 or self.displayMesh or len(frameRanges) <= 1:
+            return [self.processFrameRange(startFrame, endFrame, warmupFrames) for startFrame, endFrame in frameRanges]
+        numWorkers = min(self.numWorkers, len(frameRanges)) #each worker process imports mediapipe and builds a face mesh, which isn't worth it for a worker with nothing to do
+        instruments.log(Verbosity.NORMAL, f"Processing {len(frameRanges)} frame ranges with {numWorkers} workers")
+        #---workers are spawned rather than forked, since a forked child would inherit locks (such as the instrumentation's) that another thread of this process may be holding, and block on them forever
+        with ProcessPoolExecutor(max_workers=numWorkers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [executor.submit(processVideoRange, self.videoSource, self.workerSettings(), startFrame, endFrame, warmupFrames, instruments.verbosity) for startFrame, endFrame in frameRanges]
+            landmarkRanges = []
+            for future in futures:
+                rangeLandmarks, workerMetrics = future.result()
+                instruments.merge(workerMetrics) #so that the per frame timers cover the worker processes too
+                landmarkRanges.append(rangeLandmarks)
+            return landmarkRanges
         
     def displayVideo(self, image, textToDisplay):        
         cv2.putText(image, textToDisplay, self.fontDisplayPosition, cv2.FONT_HERSHEY_DUPLEX, self.fontScale, self.fontColor, self.fontThickness)
@@ -99,41 +373,51 @@ class VideoFaceProcessor:
                 #print(f"timestamp:{landmark.timestamp}: {points}") 
 
     def calculateLipMovement(self):        
+        for faceID, landmarks in self.faces.items():
+            self.analyseLipMovement(landmarks)
+
+    def analyseLipMovement(self, landmarks):
         #---calculate average lip separation distance for all frames
-        for faceID, landmarkDeque in self.faces.items():
-            #print(f"{len(landmarkDeque)} landmarks")
-            prevLipSeparation = 0
-            for landmark in landmarkDeque:#landmark is a landmarkObject
-                faceHeight = abs(math.dist(landmark.points[self.topOfHead], landmark.points[self.tipOfChin]))
-                #--calculate distances between opposing points on upper and lower lips
-                averageDistance = self.calculateAverageLipOpenDistance(landmark.points)
-                #---normalize distances based on face height
-                normalizedLipSeparation = averageDistance * 100 / faceHeight 
-                landmark.storeLipSeparation(normalizedLipSeparation)                    
-                t = float("{:.2f}".format(landmark.timestamp)); d = float("{:.2f}".format(abs(landmark.lipSeparation - prevLipSeparation))); s = float("{:.2f}".format(landmark.lipSeparation));
-                print(f"Time{t} diff:{d} Sep:{s}")
-                prevLipSeparation = landmark.lipSeparation
-            self.determineSilencePhases(landmarkDeque)
+        points = landmarks.points.astype(np.float64)
+        [topOfHead, tipOfChin] = landmarks.pointColumns([self.topOfHead, self.tipOfChin])
+        faceHeight = np.linalg.norm(points[:, topOfHead] - points[:, tipOfChin], axis=1)
+        #--calculate distances between opposing points on upper and lower lips
+        averageDistance = self.calculateAverageLipOpenDistance(landmarks)
+        #---normalize distances based on face height
+        landmarks.lipSeparation = averageDistance * 100 / faceHeight
+        if instruments.isEnabled(Verbosity.DEBUG):
+            lipSeparationChange = np.abs(np.diff(landmarks.lipSeparation, prepend=0))
+            for t, d, s in zip(landmarks.timestamps, lipSeparationChange, landmarks.lipSeparation):
+                instruments.log(Verbosity.DEBUG, f"Time{t:.2f} diff:{d:.2f} Sep:{s:.2f}")
+        self.determineSilencePhases(landmarks)
     
     def getDetectedSilences(self):
-        return self.faces[self.hardCodedFaceID] #returns the deque of landmark objects
+        return self.getLandmarkStore() #returns the LandmarkStore, which can be iterated as Landmark objects
+
+    def getLandmarkStore(self):#an empty store when no face was found
+        return self.faces.get(self.hardCodedFaceID, LandmarkStore(self.pointCodes))
         
-    def determineSilencePhases(self, landmarkDeque):
+    def determineSilencePhases(self, landmarks):
         #---use a sliding window to determine if the person is speaking (assuming 4 syllables per second https://en.wikipedia.org/wiki/Speech_tempo)
-        pastFew = deque(maxlen=self.pauseDuration)
-        mouthOpeningThreshold = 1 #distance of lip separation        
-        for i in range(0, len(landmarkDeque)):
-            pastFew.append(landmarkDeque[i].lipSeparation)
-            if all(i < mouthOpeningThreshold for i in pastFew):#mouth has been closed for a few frames
-                for j in range(i, i-len(pastFew), -1):#go in reverse and mark those landmark objects as mouth closed 
-                    landmarkDeque[j].speaking = False
-        #self.showDetectedSilencePhases(landmarkDeque)
-
-    def calculateAverageLipOpenDistance(self, points):
-        totalDistance = 0
-        for i in range(len(self.upperLipPoints)):
-            totalDistance += math.dist(points[self.upperLipPoints[i]], points[self.lowerLipPoints[i]])
-        return totalDistance / len(self.upperLipPoints)
+        #---a frame is silent if the mouth is closed for a run of at least pauseDuration frames around it (a run at the very start of the video counts whatever its length)
+        mouthClosed = landmarks.lipSeparation < self.mouthOpeningThreshold
+        silent = np.zeros(len(landmarks), dtype=bool)
+        if self.pauseDuration > 0:
+            edges = np.flatnonzero(np.diff(np.concatenate(([0], mouthClosed.astype(np.int8), [0]))))
+            runStarts = edges[0::2]; runEnds = edges[1::2] #runEnds are exclusive
+            isPause = ((runEnds - runStarts) >= self.pauseDuration) | (runStarts == 0)
+            runMarkers = np.zeros(len(landmarks) + 1, dtype=np.int32)
+            np.add.at(runMarkers, runStarts[isPause], 1)
+            np.add.at(runMarkers, runEnds[isPause], -1)
+            silent = np.cumsum(runMarkers[:-1]) > 0
+        landmarks.speaking = ~silent
+        #self.showDetectedSilencePhases(landmarks)
+
+    def calculateAverageLipOpenDistance(self, landmarks):
+        points = landmarks.points.astype(np.float64)
+        upperLip = points[:, landmarks.pointColumns(self.upperLipPoints)]
+        lowerLip = points[:, landmarks.pointColumns(self.lowerLipPoints)]
+        return np.linalg.norm(upperLip - lowerLip, axis=2).mean(axis=1)
 
     def showDetectedSilencePhases(self, landmarkDeque):
         for landmark in landmarkDeque:
@@ -153,4 +437,14 @@ class VideoFaceProcessor:
                 textToDisplay = "Silence"            
             self.displayVideo(theImage, textToDisplay)
             time.sleep(1/self.fps)
-            frameNumber = frameNumber + 1
\ No newline at end of file
+            frameNumber = frameNumber + 1
+
+def processVideoRange(videoSource, settings, startFrame, endFrame, warmupFrames, verbosity):
+    """Runs in a worker process. Each worker builds its own VideoFaceProcessor (with the settings of the parent's, see workerSettings()) and FaceMesh instance, and returns the landmarks along with the metrics it collected for this range."""
+    instruments.reset() #a reused worker process still holds the metrics of its previous range, which were already returned
+    instruments.configure(verbosity=verbosity)
+    faceProcessor = VideoFaceProcessor(videoSource)
+    for settingName, value in settings.items():
+        setattr(faceProcessor, settingName, value)
+    landmarks = faceProcessor.processFrameRange(startFrame, endFrame, warmupFrames)
+    return landmarks, instruments.snapshot()
@@ -0,0 +1,145 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+class Verbosity:
+    QUIET = 0 #nothing but errors
+    NORMAL = 1 #one line per stage
+    DETAILED = 2 #also per detected event, such as speech starting after a pause
+    DEBUG = 3 #also per frame. Hot loops only format their messages at this level
+
+class Histogram:
+    """Count, total, min, max and a bucketed distribution of observed values (bucket i counts values <= bucketBounds[i], the last bucket the rest)"""
+    def __init__(self, bucketBounds) -> None:
+        self.bucketBounds = bucketBounds
+        self.bucketCounts = [0] * (len(bucketBounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def observe(self, value):
+        self.count = self.count + 1
+        self.total = self.total + value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        bucket = 0
+        while bucket < len(self.bucketBounds) and value > self.bucketBounds[bucket]:
+            bucket = bucket + 1
+        self.bucketCounts[bucket] = self.bucketCounts[bucket] + 1
+
+    def merge(self, snapshot):
+        self.count = self.count + snapshot["count"]
+        self.total = self.total + snapshot["total"]
+        for name, pick in (("minimum", min), ("maximum", max)):
+            if snapshot[name] is not None:
+                setattr(self, name, snapshot[name] if getattr(self, name) is None else pick(getattr(self, name), snapshot[name]))
+        self.bucketCounts = [mine + theirs for mine, theirs in zip(self.bucketCounts, snapshot["bucketCounts"])]
+
+    def snapshot(self):
+        return {"count": self.count, "total": self.total, "minimum": self.minimum, "maximum": self.maximum, "mean": self.total / self.count if self.count else None, "bucketBounds": self.bucketBounds, "bucketCounts": list(self.bucketCounts)}
+
+class JsonLinesSink:
+    """Appends every event as one JSON object per line"""
+    def __init__(self, path) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        with self.lock:
+            with open(self.path, 'a') as sinkFile:
+                sinkFile.write(json.dumps(event) + "\n")
+
+class Instrumentation:
+    """Counters, histograms and timers for the pipeline, plus verbosity controlled console messages.
+    Events (finished stages and summaries) go to the sinks, which are callables taking a dict, e.g. a JsonLinesSink or an in-process callback.
+    Timers are histograms of seconds. timer() only aggregates, so it is cheap enough for per-frame use; stage() also emits an event, and a console line at DETAILED verbosity.
+    """
+    def __init__(self, verbosity=Verbosity.NORMAL, sinks=None) -> None:
+        self.verbosity = verbosity
+        self.sinks = list(sinks) if sinks else []
+        self.timerBuckets = [1e-5 * 4**i for i in range(10)] #10us to about 2.6s
+        self.counters = {} #{name: number}
+        self.histograms = {} #{name: Histogram}
+        self.lock = threading.Lock() #the audio and video sides run in separate threads
+
+    def configure(self, verbosity=None, sinks=None):
+        if verbosity is not None:
+            self.verbosity = verbosity
+        if sinks is not None:
+            self.sinks = list(sinks)
+
+    def isEnabled(self, verbosity):
+        return self.verbosity >= verbosity
+
+    def log(self, verbosity, message):
+        if self.verbosity >= verbosity:
+            print(message)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, value, bucketBounds=None):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(bucketBounds or self.timerBuckets)
+            self.histograms[name].observe(value)
+
+    @contextmanager
+    def timer(self, name):
+        startTime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - startTime)
+
+    @contextmanager
+    def stage(self, name):
+        startTime = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - startTime
+            self.observe(name, seconds)
+            self.emit({"type": "stage", "name": name, "seconds": seconds})
+            self.log(Verbosity.DETAILED, f"{name} took {seconds:.2f}s")
+
+    def emit(self, event):
+        if not self.sinks:
+            return
+        event = dict(event, time=time.time())
+        for sink in self.sinks:
+            sink(event)
+
+    def snapshot(self):
+        with self.lock:
+            return {"counters": dict(self.counters), "histograms": {name: histogram.snapshot() for name, histogram in self.histograms.items()}}
+
+    def merge(self, snapshot):#adds in the metrics collected elsewhere, e.g. by a worker process
+        with self.lock:
+            for name, amount in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+            for name, histogramSnapshot in snapshot["histograms"].items():
+                if name not in self.histograms:
+                    self.histograms[name] = Histogram(histogramSnapshot["bucketBounds"])
+                self.histograms[name].merge(histogramSnapshot)
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def emitSummary(self):
+        self.emit(dict(self.snapshot(), type="summary"))
+
+    def reportSummary(self):
+        snapshot = self.snapshot()
+        self.log(Verbosity.NORMAL, "Counters: " + ", ".join(f"{name}={amount}" for name, amount in sorted(snapshot["counters"].items())))
+        for name, histogram in sorted(snapshot["histograms"].items()):
+            self.log(Verbosity.NORMAL, f"  {name}: count {histogram['count']}, mean {histogram['mean']:.6f}, total {histogram['total']:.3f}")
+
+instruments = Instrumentation() #shared by all modules of the process
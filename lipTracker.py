@@ -0,0 +1,84 @@
+import cv2
+import numpy as np
+from instrumentation import instruments
+
+class LipTracker:
+    """Carries the face points of a face mesh keyframe forward to the following frames, so that the full face mesh only has to run on keyframes.
+    The lip points are tracked with pyramidal Lucas-Kanade optical flow on a greyscale crop around the mouth, and the top of head and tip of chin points are moved along with the median lip motion.
+    Tracking is given up (and the next frame should be a keyframe) when a point can't be followed, or when tracking it back to the previous frame doesn't land near where it started.
+    The keyframe interval adapts: a keyframe whose lip separation differs from the tracked one by more than lipSeparationTolerance halves the interval, otherwise it grows back towards maximumKeyframeInterval.
+    """
+    def __init__(self, headColumns, upperLipColumns, lowerLipColumns, maximumKeyframeInterval=5, lipSeparationTolerance=0.3) -> None:
+        self.headColumns = headColumns #columns of the top of head and tip of chin points in a frame's points
+        self.upperLipColumns = upperLipColumns
+        self.lowerLipColumns = lowerLipColumns
+        self.lipColumns = upperLipColumns + lowerLipColumns
+        self.maximumKeyframeInterval = maximumKeyframeInterval
+        self.lipSeparationTolerance = lipSeparationTolerance #in lip separation units (percent of face height)
+        self.keyframeInterval = maximumKeyframeInterval
+        self.cropMargin = 1.0 #the mouth crop extends this many mouth widths beyond the lip points on every side
+        self.minimumCropMargin = 16 #pixels
+        self.maximumForwardBackwardError = 1.0 #pixels
+        self.flowParameters = dict(winSize=(15, 15), maxLevel=2, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03))
+        self.previousGrey = None
+        self.previousPoints = None #(points, 3) normalized like the face mesh output
+        self.framesSinceKeyframe = 0
+
+    def needsKeyframe(self):
+        return self.previousPoints is None or self.framesSinceKeyframe >= self.keyframeInterval
+
+    def startFrom(self, grey, points, trackedPoints=None):#points are the face mesh points of this keyframe. trackedPoints are what tracking gave for the same frame, if it was tried, and set the next keyframe interval
+        if trackedPoints is not None:
+            error = abs(self.lipSeparation(trackedPoints) - self.lipSeparation(points))
+            instruments.observe("keyframeLipSeparationError", error, [0.05, 0.1, 0.2, 0.5, 1, 2, 5])
+            if error > self.lipSeparationTolerance:
+                self.keyframeInterval = max(1, self.keyframeInterval // 2)
+            else:
+                self.keyframeInterval = min(self.maximumKeyframeInterval, self.keyframeInterval + 1)
+        self.previousGrey = grey
+        self.previousPoints = np.array(points, dtype=np.float32)
+        self.framesSinceKeyframe = 0
+
+    def reset(self):
+        self.previousGrey = None
+        self.previousPoints = None
+
+    def track(self, grey):
+        """Returns this frame's points, moved on from the previous frame's, or None if they couldn't be tracked reliably."""
+        if self.previousPoints is None:
+            return None
+        height, width = grey.shape[:2]
+        scale = np.array([width, height], dtype=np.float32)
+        lipPixels = self.previousPoints[self.lipColumns, :2] * scale
+        #---crop around the mouth, so that the flow pyramids are built over a small region instead of the whole frame
+        lowest = lipPixels.min(axis=0); highest = lipPixels.max(axis=0)
+        margin = max(self.minimumCropMargin, self.cropMargin * float(highest[0] - lowest[0]))
+        left = int(max(0, lowest[0] - margin)); top = int(max(0, lowest[1] - margin))
+        right = int(min(width, highest[0] + margin + 1)); bottom = int(min(height, highest[1] + margin + 1))
+        if right - left < 2 or bottom - top < 2:#the mouth has left the frame
+            return None
+        origin = np.array([left, top], dtype=np.float32)
+        previousCrop = self.previousGrey[top:bottom, left:right]; crop = grey[top:bottom, left:right]
+        startPixels = (lipPixels - origin).reshape(-1, 1, 2)
+        movedPixels, found, _ = cv2.calcOpticalFlowPyrLK(previousCrop, crop, startPixels, None, **self.flowParameters)
+        if movedPixels is None or not found.all():
+            return None
+        returnedPixels, foundBack, _ = cv2.calcOpticalFlowPyrLK(crop, previousCrop, movedPixels, None, **self.flowParameters)
+        if returnedPixels is None or not foundBack.all():
+            return None
+        if np.linalg.norm(returnedPixels - startPixels, axis=2).max() > self.maximumForwardBackwardError:
+            return None
+        points = self.previousPoints.copy()
+        points[self.lipColumns, :2] = (movedPixels.reshape(-1, 2) + origin) / scale
+        motion = np.median(movedPixels.reshape(-1, 2) - startPixels.reshape(-1, 2), axis=0) / scale
+        points[self.headColumns, :2] = points[self.headColumns, :2] + motion
+        self.previousGrey = grey
+        self.previousPoints = points
+        self.framesSinceKeyframe = self.framesSinceKeyframe + 1
+        return points
+
+    def lipSeparation(self, points):#the same measure as VideoFaceProcessor.analyseLipMovement, for one frame
+        points = np.asarray(points, dtype=np.float64)
+        faceHeight = np.linalg.norm(points[self.headColumns[0]] - points[self.headColumns[1]])
+        averageDistance = np.linalg.norm(points[self.upperLipColumns] - points[self.lowerLipColumns], axis=1).mean()
+        return averageDistance * 100 / faceHeight
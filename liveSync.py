@@ -0,0 +1,155 @@
+import argparse
+import os
+import shlex
+import subprocess
+import threading
+from collections import deque
+import webrtcvad
+from faceDetector import VideoFaceProcessor, LandmarkStore, mediaPipeFaceMesh
+from instrumentation import instruments, Verbosity, JsonLinesSink
+from offsetEstimator import OffsetEstimator
+from videoDecoder import FfmpegDecoder
+from voiceActivityDetection import AudioProcessor
+
+class LiveSync:
+    """Estimates the audio video offset of a live source while it plays: a file that is still being written, a named pipe, or a network stream such as udp:// or rtp://.
+    One ffmpeg process reads the source and pipes out both the audio (to the VAD) and scaled down video frames (to the face mesh), so that sources which can only be read once work too.
+    Only the last bufferSeconds of speech decisions and face points are kept. Every updateSeconds the offset is estimated again over them, so memory stays bounded and a change in offset shows up within about bufferSeconds.
+    currentOffset() gives the latest confident estimate, and listeners (callables taking offset, confidence, mediaTimestamp) plus the instrumentation sinks get every estimate as it is made, e.g. for a muxer that corrects the sync on the fly.
+    A growing file has to be in a format that can be read before it is finished, such as MPEG-TS, Matroska or fragmented MP4.
+    """
+    def __init__(self, source, nonSpeechFilterLevel=1, bufferSeconds=20, updateSeconds=2, maxOffset=1.5, analysisFps=15, analysisWidth=640) -> None:
+        self.source = source
+        self.nonSpeechFilterLevel = nonSpeechFilterLevel
+        self.bufferSeconds = bufferSeconds #how much of the latest audio and video each estimate is made from
+        self.updateSeconds = updateSeconds
+        self.maxOffset = maxOffset
+        self.analysisFps = analysisFps
+        self.analysisWidth = analysisWidth
+        self.followFile = True #a regular file is read as it grows, until stop() is called
+        self.sampleRate = 16000
+        self.frameDurationMs = 30
+        self.framesPerRead = 10 #audio frames the VAD waits for at a time, which bounds the audio side's latency
+        self.minimumConfidence = 0.2 #less confident estimates are reported, but don't replace the current offset
+        self.faceProcessor = VideoFaceProcessor(source) #for its face points and lip movement analysis
+        self.faceProcessor.setFrameRate(analysisFps)
+        self.estimator = OffsetEstimator(maxOffset)
+        self.audioDecisions = deque(maxlen=int(bufferSeconds * 1000 / self.frameDurationMs)) #(timestamp, speaking)
+        self.videoPoints = deque(maxlen=int(bufferSeconds * analysisFps) + 1) #(timestamp, face points)
+        self.lock = threading.Lock()
+        self.offset = None #the latest confident estimate
+        self.confidence = 0.0
+        self.mediaTimestamp = None #how far into the source the latest confident estimate was made
+        self.listeners = []
+        self.process = None
+        self.readers = []
+        self.stopRequested = threading.Event()
+
+    def inputOptions(self):
+        if "://" in self.source:#network stream
+            return f"-fflags nobuffer -i {shlex.quote(self.source)}"
+        if self.followFile and os.path.isfile(self.source):
+            return f"-follow 1 -i {shlex.quote('file:' + self.source)}"
+        return f"-i {shlex.quote(self.source)}" #named pipe, or a file read to its current end
+
+    def start(self):
+        #---ffmpeg writes the audio to its stdout and the video to a second pipe, and logs each video frame's timestamp on stderr
+        videoReadDescriptor, videoWriteDescriptor = os.pipe()
+        audioFilter = "aresample=async=1:first_pts=0" #fills gaps in the audio with silence, so that sample counts stay in step with timestamps
+        videoFilter = f"fps={self.analysisFps},scale='min({self.analysisWidth},iw)':-2,showinfo"
+        command = f"ffmpeg -hide_banner -nostats -loglevel info {self.inputOptions()} -map 0:a:0 -ac 1 -ar {self.sampleRate} -af {audioFilter} -f s16le pipe:1 -map 0:v:0 -vf {shlex.quote(videoFilter)} -f rawvideo -pix_fmt rgb24 pipe:{videoWriteDescriptor}"
+        instruments.count("ffmpegProcesses")
+        self.process = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE, pass_fds=(videoWriteDescriptor,), bufsize=0)
+        os.close(videoWriteDescriptor)
+        decoder = FfmpegDecoder(self.source, self.analysisFps)
+        decoder.fps = self.analysisFps
+        decoder.startReading(os.fdopen(videoReadDescriptor, 'rb', buffering=0), self.process.stderr)
+        self.readers = [threading.Thread(target=self.readAudio, args=(self.process.stdout,), daemon=True), threading.Thread(target=self.readVideo, args=(decoder,), daemon=True)]
+        for reader in self.readers:
+            reader.start()
+
+    def readAudio(self, stream):
+        vad = webrtcvad.Vad(self.nonSpeechFilterLevel)
+        for frame in AudioProcessor().stream_frame_generator(self.frameDurationMs, stream, self.sampleRate, frames_per_block=self.framesPerRead):
+            speaking = vad.is_speech(frame.bytes, self.sampleRate)
+            instruments.count("vadCalls")
+            with self.lock:
+                self.audioDecisions.append((frame.timestamp, speaking))
+
+    def readVideo(self, decoder):
+        with mediaPipeFaceMesh.FaceMesh(min_detection_confidence=self.faceProcessor.minimumDetectionConfidence, min_tracking_confidence=self.faceProcessor.minimumTrackingConfidence) as detectedMesh:
+            while True:
+                frameExists, theImage, timestamp, frameNumber = decoder.read()
+                if not frameExists:
+                    break
+                instruments.count("framesDecoded")
+                theImage.flags.writeable = False
+                with instruments.timer("faceMesh"):
+                    processedImage = detectedMesh.process(theImage)
+                if processedImage.multi_face_landmarks:
+                    points = self.faceProcessor.extractPoints(processedImage.multi_face_landmarks[0])
+                    with self.lock:
+                        self.videoPoints.append((timestamp, points))
+        decoder.frameStream.close()
+
+    def updateEstimate(self):
+        """Estimates the offset over the buffered audio and video. Returns (offset, confidence, mediaTimestamp), or None while there isn't enough of either yet."""
+        with self.lock:
+            audioDecisions = list(self.audioDecisions)
+            videoPoints = list(self.videoPoints)
+        if len(videoPoints) < 2 or len(audioDecisions) < 2:
+            return None
+        with instruments.timer("liveEstimate"):
+            landmarks = LandmarkStore.fromArrays(self.faceProcessor.pointCodes, [timestamp for timestamp, points in videoPoints], [points for timestamp, points in videoPoints])
+            self.faceProcessor.analyseLipMovement(landmarks)
+            offset, confidence = self.estimator.estimate([timestamp for timestamp, speaking in audioDecisions], [speaking for timestamp, speaking in audioDecisions], landmarks.timestamps, landmarks.lipSeparation)
+        mediaTimestamp = min(audioDecisions[-1][0], float(landmarks.timestamps[-1]))
+        if confidence >= self.minimumConfidence:
+            with self.lock:
+                self.offset, self.confidence, self.mediaTimestamp = offset, confidence, mediaTimestamp
+        instruments.emit({"type": "liveOffset", "offset": offset, "confidence": confidence, "mediaTimestamp": mediaTimestamp, "accepted": confidence >= self.minimumConfidence})
+        instruments.log(Verbosity.NORMAL, f"At {mediaTimestamp:.1f}s: offset {offset:.3f}s, confidence {confidence:.2f}")
+        for listener in self.listeners:
+            listener(offset, confidence, mediaTimestamp)
+        return offset, confidence, mediaTimestamp
+
+    def currentOffset(self):#(offset, confidence, mediaTimestamp) of the latest confident estimate. offset is None until there is one
+        with self.lock:
+            return self.offset, self.confidence, self.mediaTimestamp
+
+    def run(self):
+        """Starts reading the source and updates the estimate every updateSeconds, until the source ends or stop() is called (from another thread)."""
+        self.start()
+        try:
+            while not self.stopRequested.wait(self.updateSeconds):
+                self.updateEstimate()
+                if not any(reader.is_alive() for reader in self.readers):#the source ended
+                    break
+        finally:
+            self.stop()
+        return self.currentOffset()
+
+    def stop(self):
+        self.stopRequested.set()
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+        for reader in self.readers:
+            reader.join()
+        if self.process is not None:
+            self.process.wait()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Continuously estimate the audio video offset of a live source")
+    parser.add_argument("source", help="a growing file, a named pipe, or a stream URL such as udp://127.0.0.1:1234")
+    parser.add_argument("--filter-level", type=int, default=1, choices=range(4), help="VAD aggressiveness about filtering out non-speech")
+    parser.add_argument("--buffer", type=float, default=20, help="seconds of the latest audio and video each estimate is made from")
+    parser.add_argument("--update", type=float, default=2, help="seconds between estimates")
+    parser.add_argument("--fps", type=float, default=15, help="frame rate the face mesh analyses")
+    parser.add_argument("--metrics", default=None, help="JSON lines file that receives every estimate as a liveOffset event")
+    arguments = parser.parse_args()
+    instruments.configure(sinks=[JsonLinesSink(arguments.metrics)] if arguments.metrics else [])
+    liveSync = LiveSync(arguments.source, arguments.filter_level, arguments.buffer, arguments.update, analysisFps=arguments.fps)
+    try:
+        liveSync.run()
+    except KeyboardInterrupt:
+        liveSync.stop()
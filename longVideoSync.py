@@ -0,0 +1,115 @@
+import math
+import shlex
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from faceDetector import VideoFaceProcessor
+from instrumentation import instruments, Verbosity
+from offsetEstimator import OffsetEstimator
+from syncPipeline import runCommand
+from voiceActivityDetection import VoiceActivityDetector
+
+class WindowedSync:
+    """Syncs long videos whose offset drifts over time, in bounded memory.
+    The file is analysed one window at a time: the landmarks and speech decisions of a window are discarded as soon as its offset is estimated, so memory depends on the window length and not on the length of the file.
+    The per window offsets form an offset versus time curve, which is applied in one final ffmpeg pass, either piecewise (each stretch of the video gets its own window's offset) or as a time stretch fitted to the whole curve.
+    """
+    def __init__(self, videoSource, nonSpeechFilterLevel=1, windowSeconds=60, maxOffset=1.5) -> None:
+        self.videoSource = videoSource
+        self.nonSpeechFilterLevel = nonSpeechFilterLevel
+        self.windowSeconds = windowSeconds
+        self.maxOffset = maxOffset #audio video may be out of sync by a max of these many seconds within any one window
+        self.minimumConfidence = 0.2 #windows estimated with less confidence (e.g. nobody speaking) take the offset of the nearest confident window
+        self.offsetCurve = [] #[(window centre in seconds, offset, confidence)]
+        self.durationSeconds = None
+
+    def run(self):
+        faceProcessor = VideoFaceProcessor(self.videoSource)
+        numFrames = faceProcessor.readVideoProperties()
+        lengthKnown = numFrames > 0 and faceProcessor.fps > 0
+        if lengthKnown:
+            self.durationSeconds = numFrames / faceProcessor.fps
+            numWindows = max(1, math.ceil(self.durationSeconds / self.windowSeconds))
+            instruments.log(Verbosity.NORMAL, f"Analysing {self.durationSeconds:.0f}s of video in {numWindows} windows of {self.windowSeconds}s")
+        else:#e.g. a container that doesn't record its frame count. The whole video is then one window, as in a full pass
+            self.durationSeconds = None
+            numWindows = 1
+            instruments.log(Verbosity.NORMAL, "The video's length or frame rate is not known, so it is analysed to the end as one window")
+        self.offsetCurve = []
+        for windowNumber in range(numWindows):
+            startSeconds = windowNumber * self.windowSeconds
+            endSeconds = min(startSeconds + self.windowSeconds, self.durationSeconds) if lengthKnown else None
+            with instruments.stage("window"):
+                offset, confidence = self.analyseWindow(faceProcessor, startSeconds, endSeconds)
+            centreSeconds = (startSeconds + endSeconds) / 2 if lengthKnown else 0.0 #a single window's offset applies throughout, whatever its centre
+            self.offsetCurve.append((centreSeconds, offset, confidence))
+            instruments.emit({"type": "windowOffset", "start": startSeconds, "end": endSeconds, "offset": offset, "confidence": confidence})
+            windowRange = f"{startSeconds:.0f}s to {endSeconds:.0f}s" if lengthKnown else "the whole video"
+            instruments.log(Verbosity.NORMAL, f"Window {windowNumber + 1}/{numWindows} ({windowRange}): offset {offset:.3f}s, confidence {confidence:.2f}")
+        return self.offsetCurve
+
+    def analyseWindow(self, faceProcessor, startSeconds, endSeconds):#endSeconds=None analyses until the end of the video
+        #---the audio is analysed maxOffset further on either side, so that a video event near the window edge can still find its audio
+        audioStartSeconds = max(0, startSeconds - self.maxOffset)
+        audioDurationSeconds = None if endSeconds is None else endSeconds + self.maxOffset - audioStartSeconds
+        warmupFrames = int(faceProcessor.rangeOverlapSeconds * faceProcessor.fps)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            audioFuture = executor.submit(self.analyseWindowAudio, audioStartSeconds, audioDurationSeconds)
+            videoFuture = executor.submit(faceProcessor.processFrameRange, int(startSeconds * faceProcessor.fps), None if endSeconds is None else int(endSeconds * faceProcessor.fps), warmupFrames)
+            speechDetected = audioFuture.result()
+            landmarks = videoFuture.result()
+        if len(landmarks) < 2:#nobody on screen in this window
+            return 0.0, 0.0
+        faceProcessor.analyseLipMovement(landmarks)
+        estimator = OffsetEstimator(self.maxOffset)
+        return estimator.estimate(speechDetected.timestamps, speechDetected.speaking, landmarks.timestamps, landmarks.lipSeparation)
+
+    def analyseWindowAudio(self, startSeconds, durationSeconds):
+        vad = VoiceActivityDetector()
+        vad.runOnStream(self.videoSource, self.nonSpeechFilterLevel, startSeconds=startSeconds, durationSeconds=durationSeconds)
+        return vad.getSpeechDetectedSections()
+
+    def correctedOffsets(self):#the offset curve, with each unreliable window's offset replaced by that of the nearest reliable window (0 if there are none)
+        centres = np.array([centre for centre, offset, confidence in self.offsetCurve])
+        offsets = np.array([offset for centre, offset, confidence in self.offsetCurve])
+        reliable = np.array([confidence >= self.minimumConfidence for centre, offset, confidence in self.offsetCurve])
+        if not np.any(reliable):
+            return centres, np.zeros(len(centres))
+        reliableIndices = np.flatnonzero(reliable)
+        nearestReliable = reliableIndices[np.argmin(np.abs(centres[:, None] - centres[reliableIndices][None, :]), axis=1)]
+        return centres, offsets[nearestReliable]
+
+    def buildPiecewiseFilter(self):
+        #---the video is cut at the midpoints between window centres, and each piece takes the audio shifted by its window's offset. Audio that would have to come from before the start of the file is silence
+        centres, offsets = self.correctedOffsets()
+        boundaries = [0.0] + [(centres[i] + centres[i + 1]) / 2 for i in range(len(centres) - 1)] + [None]
+        pieces = []
+        for i, offset in enumerate(offsets):
+            startSeconds = boundaries[i] - offset; endSeconds = None if boundaries[i + 1] is None else boundaries[i + 1] - offset
+            trim = f"atrim=start={max(0.0, startSeconds):.6f}" + ("" if endSeconds is None else f":end={max(0.0, endSeconds):.6f}")
+            piece = f"[s{i}]{trim},asetpts=PTS-STARTPTS"
+            if startSeconds < 0:
+                piece += f",adelay={-startSeconds * 1000:.0f}:all=1"
+            pieces.append(piece + f"[a{i}]")
+        splitOutputs = "".join(f"[s{i}]" for i in range(len(pieces)))
+        concatInputs = "".join(f"[a{i}]" for i in range(len(pieces)))
+        return f"[0:a]asplit={len(pieces)}{splitOutputs};" + ";".join(pieces) + f";{concatInputs}concat=n={len(pieces)}:v=0:a=1[aout]"
+
+    def buildStretchFilter(self):
+        #---fit offset = initialOffset + drift * t over the windows, weighted by confidence. Output time t then plays audio from (1 - drift) * t - initialOffset, i.e. the audio is played at tempo (1 - drift) and shifted by initialOffset
+        centres, offsets = self.correctedOffsets()
+        weights = np.array([max(confidence, 1e-3) for centre, offset, confidence in self.offsetCurve])
+        if len(centres) >= 2:
+            drift, initialOffset = np.polyfit(centres, offsets, 1, w=weights)
+        else:
+            drift, initialOffset = 0.0, float(offsets[0]) if len(offsets) else 0.0
+        tempo = 1 - drift
+        instruments.log(Verbosity.NORMAL, f"Fitted offset {initialOffset:.3f}s + {drift * 3600:.3f}s per hour")
+        if initialOffset >= 0:
+            return f"[0:a]atempo={tempo:.9f},adelay={initialOffset / tempo * 1000:.0f}:all=1[aout]"
+        return f"[0:a]atrim=start={-initialOffset:.6f},asetpts=PTS-STARTPTS,atempo={tempo:.9f}[aout]"
+
+    def applyCorrection(self, outputFile, mode="piecewise"):#mode is "piecewise" or "stretch". The video stream is copied and the audio re-encoded. Returns ffmpeg's exit code
+        audioFilter = self.buildPiecewiseFilter() if mode == "piecewise" else self.buildStretchFilter()
+        command = f"ffmpeg -hide_banner -loglevel error -y -i {shlex.quote(self.videoSource)} -filter_complex {shlex.quote(audioFilter)} -map 0:v -map [aout] -c:v copy {shlex.quote(outputFile)}"
+        with instruments.stage("applyCorrection"):
+            return runCommand(command)
@@ -1,26 +1,12 @@
 import os
-import shlex #useful for recognizing quotes inside a command to be split
-import subprocess
-from collections import deque
-import matplotlib.pyplot as plt
-from faceDetector import VideoFaceProcessor
-from voiceActivityDetection import VoiceActivityDetector
-
-def runCommand(command):
-    command = shlex.split(command)       
-    try:
-        process = subprocess.Popen(command)        
-        #---keep polling
-        while True: 
-            returnCode = process.poll() #checking if process ended (could also use psutil to check)
-            if returnCode == None: #process still running
-                pass
-            else: #process completed
-                break
-    except subprocess.CalledProcessError as e:
-        print("Ran into some errors:", e) 
+from instrumentation import instruments, JsonLinesSink, Verbosity
+from longVideoSync import WindowedSync
+from progressiveSync import ProgressiveSync
+from resultCache import ResultCache
+from syncPipeline import SyncPipeline, applyOffset
 
 def plotSpeechDetected(audioMarkers, videoMarkers):
+    import matplotlib.pyplot as plt #imported here, since it is slow to import and only needed for this plot
     audioTimestamps = []; videoTimestamps = []
     audioSpeaking = []; videoSpeaking = []
     for frame in videoMarkers:        
@@ -35,85 +21,55 @@ def plotSpeechDetected(audioMarkers, videoMarkers):
     axs[1].plot(videoTimestamps, videoSpeaking); axs[1].set(xlabel='timestamp', ylabel='video')
     plt.show() 
 
-def searchNearbyAudioTimestamps(audioCrucialPoints, videoTimestamp):
-    maxOffset = 1.5 #audio video may be out of sync by a max of these many seconds
-    nearestAudioIndex = None #audio index of speech that's closest to the video timestamp
-    closestValue = 999
-    for i in range(0, len(audioCrucialPoints)):
-        val = abs(videoTimestamp - audioCrucialPoints[i])
-        if val <= maxOffset:#is within range of the video timestamp offset allowed
-            if val < closestValue:#find the closest offset detected
-                closestValue = val
-                nearestAudioIndex = i
-    return nearestAudioIndex
-
 
 if __name__ == '__main__':
-    waveExtension = ".wav"
     mp4Extension = ".mp4"
     #videoSource = "thePause2.mp4"
     videoSource = "thePause2_withAudioOffset.mp4"
     nonSpeechFilterLevel = 1
-    filenameWithoutExtension = os.path.splitext(videoSource)[0] #remove extension
-    
-    #---Create an audio file from the video file
-    command = f"ffmpeg -hide_banner -loglevel error -y -i {videoSource} -vn -ac 1 {filenameWithoutExtension}{waveExtension}"    
-    runCommand(command)
-    
-    #---Analyze audio to detect speech
-    print("Processing audio")
-    vad = VoiceActivityDetector()
-    vad.run(f"{filenameWithoutExtension}{waveExtension}", nonSpeechFilterLevel)
-    audioMarkers = vad.getSpeechDetectedSections()
-    
-    #---Analyze lip movements to detect silences
-    print("Processing video")
-    faceProcessor = VideoFaceProcessor(videoSource)
-    faceProcessor.run()
-    videoMarkers = faceProcessor.getDetectedSilences()
-    ##faceProcessor.displayPoints()
-    
-    #---Check for Audio Video sync issues
-    print(f"Num. audio points {len(audioMarkers)}") 
-    print(f"Num. video points {len(videoMarkers)}")
-    numFramesToCheck = 15
-    detectionWindow = deque(maxlen=numFramesToCheck)
-    videoCrucialPoints = []; audioCrucialPoints = []   
-    plotSpeechDetected(audioMarkers, videoMarkers)
-    print('--------- video')
-    for frame in videoMarkers:        
-        #---detect the point at which speaking starts after a pause
-        if len(detectionWindow) == numFramesToCheck and all(i == False for i in detectionWindow) and frame.speaking == True:#the False means notSpeaking and True means speaking
-            print("Speaking started after a silence at: ", frame.timestamp, frame.speaking)
-            videoCrucialPoints.append(frame.timestamp)
-        detectionWindow.append(frame.speaking)
-    print('--------- audio')
-    detectionWindow = deque(maxlen=numFramesToCheck)
-    for frame in audioMarkers:        
-        #---detect the point at which speaking starts after a pause
-        if len(detectionWindow) == numFramesToCheck and all(i == False for i in detectionWindow) and frame.speaking == True:#the False means notSpeaking and True means speaking
-            print("Speaking started after a silence at: ", frame.timestamp, frame.speaking)
-            audioCrucialPoints.append(frame.timestamp)
-        detectionWindow.append(frame.speaking)
-    allDiffs = []
-    for i in range(0, len(videoCrucialPoints)):
-        offsetIndex = searchNearbyAudioTimestamps(audioCrucialPoints, videoCrucialPoints[i])
-        if offsetIndex == None:
-            print(f"No nearby audio found for point {i} of video")
-        diff = videoCrucialPoints[i] - audioCrucialPoints[offsetIndex]
-        if diff == 0:
-            print(f"point {i}: Audio and video are in sync")
-        if diff > 0:
-            print(f"point {i}: Video is ahead of audio by {diff}s")
-        if diff < 0:
-            print(f"point {i}: Audio is ahead of video by {diff}s")            
-        allDiffs.append(diff)
-    
-    #---calculate an approximate offset to perform
-    offset = allDiffs[0] #most reliable async
-    print(f"Offset is {offset}s. Adjusting audio in video by this much.")
+    numVideoWorkers = os.cpu_count() or 1 #face mesh processes that landmark the video in parallel. Short videos use fewer, since each range needs at least 5 seconds. Set to 1 for a serial pass, which parallel results only approximately match, since each range's face mesh starts tracking afresh
+    videoSettings = {} #e.g. {"keyframeInterval": 5} runs the face mesh on every 5th frame (more often when tracking is unreliable) and tracks the lips by optical flow in between. {"decodeBackend": "ffmpeg", "analysisFps": 15, "analysisWidth": 640} decodes through ffmpeg at reduced size and frame rate
+    audioGuidedVideo = False #True analyzes the audio first and landmarks only the video near where speech starts in the audio
+    useCache = True #reuse landmarks and speech decisions computed by earlier runs on the same file with the same parameters
+    verbosity = Verbosity.NORMAL #Verbosity.DEBUG prints every frame
+    longVideoMode = None #"piecewise" or "stretch" analyzes the file in windows of longVideoWindowSeconds with bounded memory, and corrects the offset per window or by a fitted drift, instead of applying one offset to the whole file
+    longVideoWindowSeconds = 60
+    progressiveMode = False #True analyzes the file from the start and stops as soon as the first few speech start matches agree on the offset, falling back to the whole file if they don't
+    metricsFile = None #e.g. "metrics.jsonl" to record stage timings and a summary of the counters and timers
+    instruments.configure(verbosity, [JsonLinesSink(metricsFile)] if metricsFile else [])
     
-    #---Do the sync
-    command = f"ffmpeg -hide_banner -loglevel error -y -i {videoSource} -itsoffset {offset} -i {videoSource} -map 0:v -map 1:a -c copy sync{mp4Extension}"  #https://superuser.com/questions/982342/in-ffmpeg-how-to-delay-only-the-audio-of-a-mp4-video-without-converting-the-au
-    runCommand(command)     
-    print(f"\n\nProgram complete. Synched file is: sync{mp4Extension}")            
\ No newline at end of file
+    if longVideoMode:
+        #---Analyze the file window by window and correct the drift between windows
+        windowedSync = WindowedSync(videoSource, nonSpeechFilterLevel, longVideoWindowSeconds)
+        windowedSync.run()
+        windowedSync.applyCorrection(f"sync{mp4Extension}", longVideoMode)
+    elif progressiveMode:
+        #---Analyze only as much of the file as it takes for the offset to converge
+        offset, confidence = ProgressiveSync(videoSource, nonSpeechFilterLevel).run()
+        instruments.log(Verbosity.QUIET, f"Offset is {offset:.3f}s (confidence {confidence:.2f}). Adjusting audio in video by this much.")
+        with instruments.stage("applyOffset"):
+            applyOffset(videoSource, offset, f"sync{mp4Extension}")
+    else:
+        pipeline = SyncPipeline(videoSource, nonSpeechFilterLevel, numVideoWorkers, ResultCache() if useCache else None)
+        pipeline.videoSettings = videoSettings
+        if audioGuidedVideo:
+            audioMarkers, videoMarkers = pipeline.runAudioGuided()
+        else:
+            #---Extract and analyze the audio while the lip movements are analyzed
+            audioMarkers, videoMarkers = pipeline.run()
+        
+        #---Check for Audio Video sync issues
+        instruments.log(Verbosity.NORMAL, f"Num. audio points {len(audioMarkers)}") 
+        instruments.log(Verbosity.NORMAL, f"Num. video points {len(videoMarkers)}")
+        plotSpeechDetected(audioMarkers, videoMarkers)
+        
+        #---calculate the offset to perform
+        offset, confidence = pipeline.estimateOffset()
+        instruments.log(Verbosity.QUIET, f"Offset is {offset:.3f}s (confidence {confidence:.2f}). Adjusting audio in video by this much.")
+        
+        #---Do the sync
+        with instruments.stage("applyOffset"):
+            applyOffset(videoSource, offset, f"sync{mp4Extension}")
+    instruments.reportSummary()
+    instruments.emitSummary()
+    instruments.log(Verbosity.QUIET, f"\n\nProgram complete. Synched file is: sync{mp4Extension}")            
\ No newline at end of file
@@ -0,0 +1,73 @@
+import numpy as np
+
+class OffsetEstimator:
+    """Estimates the audio video offset by cross-correlating the audio speech signal with the video lip separation signal.
+    Both signals are resampled onto a common time grid and the best lag within +/- maxOffset is found with one FFT based cross-correlation.
+    The offset is video timestamp minus audio timestamp of the same event, i.e. how much the audio needs to be delayed (the -itsoffset given to ffmpeg).
+    """
+    def __init__(self, maxOffset=1.5, gridStep=0.01) -> None:
+        self.maxOffset = maxOffset #audio video may be out of sync by a max of these many seconds
+        self.gridStep = gridStep #seconds between samples of the common time grid
+        self.lags = None #lags (seconds) that were searched, after estimate()
+        self.correlations = None #normalized correlation at each lag, after estimate()
+
+    def estimate(self, audioTimestamps, audioSpeaking, videoTimestamps, videoLipSeparation):
+        """Returns (offset in seconds, confidence between 0 and 1). The confidence is the correlation coefficient of the two signals at the best lag."""
+        audioTimestamps = np.asarray(audioTimestamps, dtype=np.float64); audioSpeaking = np.asarray(audioSpeaking, dtype=np.float64)
+        videoTimestamps = np.asarray(videoTimestamps, dtype=np.float64); videoLipSeparation = np.asarray(videoLipSeparation, dtype=np.float64)
+        if len(audioTimestamps) < 2 or len(videoTimestamps) < 2:
+            return 0.0, 0.0
+        #---resample both signals onto a common grid
+        gridStart = min(audioTimestamps[0], videoTimestamps[0]); gridEnd = max(audioTimestamps[-1], videoTimestamps[-1])
+        grid = np.arange(gridStart, gridEnd + self.gridStep, self.gridStep)
+        audioCovered = self.coverage(audioTimestamps, grid); videoCovered = self.coverage(videoTimestamps, grid)
+        audioSignal = self.normalize(self.sampleAndHold(audioTimestamps, audioSpeaking, grid), audioCovered)
+        videoSignal = self.normalize(np.interp(grid, videoTimestamps, videoLipSeparation), videoCovered)
+        #---cross-correlate: correlation[lag] = sum over t of audio[t] * video[t + lag], divided by the number of grid points where both signals are covered at that lag
+        numSamples = len(grid)
+        maxLag = min(int(round(self.maxOffset / self.gridStep)), numSamples - 1)
+        lagSteps = np.arange(-maxLag, maxLag + 1)
+        crossCorrelation = self.crossCorrelate(audioSignal, videoSignal, lagSteps)
+        overlap = np.maximum(np.round(self.crossCorrelate(audioCovered.astype(np.float64), videoCovered.astype(np.float64), lagSteps)), 1)
+        self.correlations = crossCorrelation / overlap
+        self.lags = lagSteps * self.gridStep
+        best = int(np.argmax(self.correlations))
+        offset = self.lags[best] + self.refinePeak(best) * self.gridStep
+        confidence = float(np.clip(self.correlations[best], 0, 1))
+        return float(offset), confidence
+
+    def crossCorrelate(self, first, second, lagSteps):#returns sum over t of first[t] * second[t + lag] for each lag, zero padded so that the FFT does not wrap around
+        fftSize = 1 << int(np.ceil(np.log2(2 * len(first))))
+        crossCorrelation = np.fft.irfft(np.conj(np.fft.rfft(first, fftSize)) * np.fft.rfft(second, fftSize), fftSize)
+        return crossCorrelation[lagSteps % fftSize]
+
+    def sampleAndHold(self, timestamps, values, grid):#each grid point takes the value of the latest sample at or before it (VAD decisions hold for the whole frame)
+        indices = np.clip(np.searchsorted(timestamps, grid, side='right') - 1, 0, len(timestamps) - 1)
+        return values[indices]
+
+    def coverage(self, timestamps, grid):
+        #---grid points further than a couple of sample intervals from any sample are not covered by the signal (before it starts, after it ends, or in gaps such as frames without a detected face)
+        sampleInterval = np.median(np.diff(timestamps))
+        nextIndices = np.clip(np.searchsorted(timestamps, grid), 0, len(timestamps) - 1)
+        previousIndices = np.clip(nextIndices - 1, 0, len(timestamps) - 1)
+        distance = np.minimum(np.abs(timestamps[nextIndices] - grid), np.abs(grid - timestamps[previousIndices]))
+        return distance <= 2 * max(sampleInterval, self.gridStep)
+
+    def normalize(self, signal, covered):#zero mean and unit variance over the covered grid points, and zero where not covered so those points add nothing to the correlation
+        normalized = np.zeros(len(signal))
+        if not np.any(covered):
+            return normalized
+        values = signal[covered]
+        deviation = values.std()
+        if deviation > 0:
+            normalized[covered] = (values - values.mean()) / deviation
+        return normalized
+
+    def refinePeak(self, best):#fits a parabola through the peak and its neighbours, returning the fraction of a grid step by which the true peak is off the best lag
+        if best == 0 or best == len(self.correlations) - 1:
+            return 0.0
+        left, centre, right = self.correlations[best - 1:best + 2]
+        curvature = left - 2 * centre + right
+        if curvature >= 0:
+            return 0.0
+        return 0.5 * (left - right) / curvature
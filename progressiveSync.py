@@ -0,0 +1,141 @@
+import bisect
+import math
+import statistics
+import numpy as np
+import webrtcvad
+from faceDetector import VideoFaceProcessor, LandmarkStore
+from instrumentation import instruments, Verbosity
+from offsetEstimator import OffsetEstimator
+from syncPipeline import findSpeechStartTimes, searchNearbyAudioTimestamps
+from voiceActivityDetection import AudioProcessor
+
+class ProgressiveSync:
+    """Analyses the file from the start, chunkSeconds at a time, matching each speech start in the video to the nearest one in the audio as they are found, and stops as soon as the offsets of the latest requiredMatches matches agree to within agreementTolerance.
+    On typical content that happens within the first minute or two, so the rest of the file is never decoded. If the matches never agree, the whole file ends up analysed and the offset is estimated from all of it by cross correlation, as in a full pass.
+    """
+    def __init__(self, videoSource, nonSpeechFilterLevel=1, chunkSeconds=10, requiredMatches=3, agreementTolerance=0.1, maxOffset=1.5) -> None:
+        self.videoSource = videoSource
+        self.nonSpeechFilterLevel = nonSpeechFilterLevel
+        self.chunkSeconds = chunkSeconds
+        self.requiredMatches = requiredMatches
+        self.agreementTolerance = agreementTolerance #seconds
+        self.maxOffset = maxOffset #audio video may be out of sync by a max of these many seconds
+        self.numFramesToCheck = 15 #frames of silence that must precede speech for it to count as speech starting after a pause
+        self.settleSeconds = 1 #speech starts this close to the end of the analysed video are not matched yet, since the silence before them may still turn out too short when the next chunk is analysed
+        self.sampleRate = 16000
+        self.frameDurationMs = 30
+        self.matches = [] #[(video timestamp, offset)] in video timestamp order
+        self.videoSpeechStarts = [] #timestamps at which speech starts after a pause, in the video analysed so far
+        self.numStartsMatched = 0 #how many of videoSpeechStarts have been looked up in the audio
+        self.audioSpeechStarts = []
+        self.numAudioScanned = 0 #VAD decisions already searched for speech starts
+        self.analysedSeconds = 0
+        self.converged = False
+
+    def run(self):
+        """Returns (offset, confidence). offset is video minus audio, as applyOffset() takes it."""
+        faceProcessor = VideoFaceProcessor(self.videoSource)
+        numFrames = faceProcessor.readVideoProperties()
+        lengthKnown = numFrames > 0 and faceProcessor.fps > 0
+        if not lengthKnown:#e.g. a container that doesn't record its frame count. The whole video is then one chunk, as in a full pass
+            instruments.log(Verbosity.NORMAL, "The video's length or frame rate is not known, so it is analysed to the end in one go")
+        durationSeconds = numFrames / faceProcessor.fps if lengthKnown else math.inf
+        landmarks = LandmarkStore(faceProcessor.pointCodes)
+        audioTimestamps = []; audioSpeaking = []
+        audioProcessor = AudioProcessor()
+        audioProcess = audioProcessor.open_pcm_stream(self.videoSource, self.sampleRate)
+        audioFrames = audioProcessor.stream_frame_generator(self.frameDurationMs, audioProcess.stdout, self.sampleRate, frames_per_block=100)
+        vad = webrtcvad.Vad(self.nonSpeechFilterLevel)
+        self.matches = []; self.videoSpeechStarts = []; self.numStartsMatched = 0; self.audioSpeechStarts = []; self.numAudioScanned = 0; self.converged = False
+        try:
+            with faceProcessor.openFaceMesh() as detectedMesh:
+                faceProcessor.faceMesh = detectedMesh #one face mesh for all chunks, so its tracking carries on from one chunk into the next
+                startSeconds = 0
+                while not self.converged:
+                    endSeconds = startSeconds + self.chunkSeconds
+                    isLastChunk = not lengthKnown or endSeconds >= durationSeconds
+                    with instruments.stage("progressiveChunk"):
+                        chunk = faceProcessor.processFrameRange(int(startSeconds * faceProcessor.fps), None if isLastChunk else int(endSeconds * faceProcessor.fps))
+                        #---the audio is read maxOffset beyond the video, so that a video speech start near the end of the chunk can still find its audio
+                        self.readAudio(audioFrames, vad, audioTimestamps, audioSpeaking, math.inf if isLastChunk else endSeconds + self.maxOffset)
+                        self.analyseChunk(faceProcessor, landmarks, chunk)
+                    if lengthKnown:
+                        self.analysedSeconds = min(endSeconds, durationSeconds)
+                    else:
+                        self.analysedSeconds = float(landmarks.timestamps[-1]) if len(landmarks) else 0.0
+                    self.updateMatches(audioTimestamps, audioSpeaking, None if isLastChunk else self.analysedSeconds - self.settleSeconds)
+                    if isLastChunk:
+                        break
+                    startSeconds = endSeconds
+        finally:
+            faceProcessor.faceMesh = None
+            audioProcess.kill()
+            audioProcess.wait()
+            audioProcess.stdout.close()
+        if self.converged:
+            offset = statistics.median(offset for timestamp, offset in self.matches[-self.requiredMatches:])
+            confidence = sum(abs(matchOffset - offset) <= self.agreementTolerance for timestamp, matchOffset in self.matches) / len(self.matches)
+            instruments.log(Verbosity.NORMAL, f"Offset converged after {self.analysedSeconds:.0f}s of {durationSeconds:.0f}s" if lengthKnown else f"Offset converged after {self.analysedSeconds:.0f}s")
+            return offset, confidence
+        instruments.log(Verbosity.NORMAL, "Speech start matches did not agree, estimating the offset from the whole file")
+        if len(landmarks) < 2 or not audioTimestamps:
+            return 0.0, 0.0
+        with instruments.stage("offsetEstimation"):
+            return OffsetEstimator(self.maxOffset).estimate(audioTimestamps, audioSpeaking, landmarks.timestamps, landmarks.lipSeparation)
+
+    def readAudio(self, audioFrames, vad, audioTimestamps, audioSpeaking, untilSeconds):#runs the VAD on the audio up to untilSeconds (or the end of the audio)
+        if audioTimestamps and audioTimestamps[-1] >= untilSeconds:
+            return
+        for frame in audioFrames:
+            audioTimestamps.append(frame.timestamp)
+            audioSpeaking.append(vad.is_speech(frame.bytes, self.sampleRate))
+            instruments.count("vadCalls")
+            if frame.timestamp + frame.duration >= untilSeconds:
+                break
+
+    def analyseChunk(self, faceProcessor, landmarks, chunk):
+        """Works out the lip separation and silences of a newly landmarked chunk and appends it to landmarks, then finds the speech starts it adds.
+        The frames analysed before are not gone over again, except for a mouth closed run that reaches the end of them, since it can turn into a pause by carrying on into this chunk.
+        """
+        numFrames = len(landmarks)
+        contextFrames = 0
+        if numFrames > 0:
+            #---at most pauseDuration + 1 frames back: a closed run that long is a pause already, and stays one
+            recentClosed = landmarks.lipSeparation[max(0, numFrames - faceProcessor.pauseDuration - 1):] < faceProcessor.mouthOpeningThreshold
+            openFrames = np.flatnonzero(~recentClosed)
+            contextFrames = len(recentClosed) - openFrames[-1] if len(openFrames) else len(recentClosed) #from the open frame before the run, so that the run isn't taken for one at the start of the video
+        firstFrame = numFrames - contextFrames
+        recent = LandmarkStore.fromArrays(faceProcessor.pointCodes, np.concatenate((landmarks.timestamps[firstFrame:], chunk.timestamps)), np.concatenate((landmarks.points[firstFrame:], chunk.points)))
+        faceProcessor.analyseLipMovement(recent)
+        if contextFrames:
+            landmarks.speaking[firstFrame:] = recent.speaking[:contextFrames]
+        chunk.lipSeparation = recent.lipSeparation[contextFrames:]; chunk.speaking = recent.speaking[contextFrames:]
+        landmarks.extend(chunk)
+        #---speech starts from firstFrame on may have changed, and finding them needs the numFramesToCheck frames before
+        if firstFrame < len(landmarks):
+            changedSince = landmarks.timestamps[firstFrame]
+            del self.videoSpeechStarts[bisect.bisect_left(self.videoSpeechStarts, changedSince):]
+            self.numStartsMatched = min(self.numStartsMatched, len(self.videoSpeechStarts))
+            while self.matches and self.matches[-1][0] >= changedSince:
+                self.matches.pop()
+            scanFrom = max(0, firstFrame - self.numFramesToCheck)
+            self.videoSpeechStarts.extend(findSpeechStartTimes(landmarks.timestamps[scanFrom:], landmarks.speaking[scanFrom:], self.numFramesToCheck))
+
+    def updateMatches(self, audioTimestamps, audioSpeaking, settledUntilSeconds):#settledUntilSeconds=None matches every video speech start
+        #---only the audio read since the last update is searched for speech starts, along with the numFramesToCheck decisions before it
+        scanFrom = max(0, self.numAudioScanned - self.numFramesToCheck)
+        self.audioSpeechStarts.extend(findSpeechStartTimes(audioTimestamps[scanFrom:], audioSpeaking[scanFrom:], self.numFramesToCheck))
+        self.numAudioScanned = len(audioTimestamps)
+        while self.numStartsMatched < len(self.videoSpeechStarts):
+            videoTimestamp = self.videoSpeechStarts[self.numStartsMatched]
+            if settledUntilSeconds is not None and videoTimestamp > settledUntilSeconds:
+                break
+            audioIndex = searchNearbyAudioTimestamps(self.audioSpeechStarts, videoTimestamp, self.maxOffset)
+            if audioIndex is not None:
+                self.matches.append((videoTimestamp, videoTimestamp - self.audioSpeechStarts[audioIndex]))
+            self.numStartsMatched = self.numStartsMatched + 1
+        latestOffsets = [offset for timestamp, offset in self.matches[-self.requiredMatches:]]
+        if len(latestOffsets) == self.requiredMatches:
+            median = statistics.median(latestOffsets)
+            self.converged = all(abs(offset - median) <= self.agreementTolerance for offset in latestOffsets)
+        instruments.log(Verbosity.DETAILED, f"{self.analysedSeconds:.0f}s analysed, {len(self.matches)} speech start matches, latest offsets {latestOffsets}")
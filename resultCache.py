@@ -0,0 +1,91 @@
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+import numpy as np
+
+class ResultCache:
+    """Content addressed on-disk cache of analysis results (landmarks, VAD decisions) stored as .npz files.
+    An entry's key is a hash of the source file's contents plus the parameters that were used to produce it, so a changed file or changed parameters never hit a stale entry.
+    The total size of the cache is kept under maxBytes by evicting the least recently used entries.
+    """
+    def __init__(self, cacheDirectory=None, maxBytes=2 * 1024**3) -> None:
+        if cacheDirectory is None:
+            cacheDirectory = os.path.join(os.path.expanduser("~"), ".cache", "audio_video_synchronizer")
+        self.cacheDirectory = cacheDirectory
+        self.maxBytes = maxBytes
+        self.fileExtension = ".npz"
+        self.hashBlockSize = 1024 * 1024
+        self.fileHashes = {} #{(path, size, modification time): content hash} so that a file is hashed only once per process
+        os.makedirs(self.cacheDirectory, exist_ok=True)
+
+    def fileHash(self, path):
+        fileStatus = os.stat(path)
+        fileIdentity = (os.path.abspath(path), fileStatus.st_size, fileStatus.st_mtime_ns)
+        if fileIdentity not in self.fileHashes:
+            contentHash = hashlib.sha256()
+            with open(path, 'rb') as fileHandle:
+                for block in iter(lambda: fileHandle.read(self.hashBlockSize), b''):
+                    contentHash.update(block)
+            self.fileHashes[fileIdentity] = contentHash.hexdigest()
+        return self.fileHashes[fileIdentity]
+
+    def key(self, sourceFile, resultKind, parameters):#resultKind names what is cached (e.g. "landmarks"), parameters is a JSON serializable dict of everything that affects the result
+        description = json.dumps({"source": self.fileHash(sourceFile), "kind": resultKind, "parameters": parameters}, sort_keys=True)
+        return f"{resultKind}-{hashlib.sha256(description.encode()).hexdigest()}"
+
+    def entryPath(self, key):
+        return os.path.join(self.cacheDirectory, key + self.fileExtension)
+
+    def load(self, key, requiredNames=()):
+        """Returns {arrayName: array} for a cached entry, or None if there is no such entry, it is corrupt, or it lacks any of requiredNames"""
+        path = self.entryPath(key)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+                missingNames = [name for name in requiredNames if name not in arrays]
+                if missingNames:
+                    raise KeyError(missingNames[0])
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError, zipfile.BadZipFile, KeyError):#an empty, corrupt or truncated entry, which is removed so that the next save writes it afresh
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return None
+        os.utime(path) #the modification time records when an entry was last used, for LRU eviction
+        return arrays
+
+    def save(self, key, **arrays):
+        #---write to a temporary file first, so that a concurrent reader or an interrupted write never sees a partial entry
+        fileDescriptor, temporaryPath = tempfile.mkstemp(dir=self.cacheDirectory, suffix=".tmp")
+        try:
+            with os.fdopen(fileDescriptor, 'wb') as fileHandle:
+                np.savez(fileHandle, **arrays)
+            os.replace(temporaryPath, self.entryPath(key))
+        except BaseException:
+            os.remove(temporaryPath)
+            raise
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for fileName in os.listdir(self.cacheDirectory):
+            if fileName.endswith(self.fileExtension):
+                path = os.path.join(self.cacheDirectory, fileName)
+                try:
+                    fileStatus = os.stat(path)
+                except FileNotFoundError:#evicted by another process meanwhile
+                    continue
+                entries.append((fileStatus.st_mtime, fileStatus.st_size, path))
+        totalBytes = sum(size for lastUsed, size, path in entries)
+        for lastUsed, size, path in sorted(entries):#least recently used first
+            if totalBytes <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            totalBytes = totalBytes - size
@@ -0,0 +1,182 @@
+import os
+import shlex #useful for recognizing quotes inside a command to be split
+import subprocess
+import time
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import numpy as np
+from faceDetector import VideoFaceProcessor
+from instrumentation import instruments, Verbosity
+from offsetEstimator import OffsetEstimator
+from voiceActivityDetection import VoiceActivityDetector
+
+def runCommand(command):
+    command = shlex.split(command)
+    instruments.count("ffmpegProcesses")
+    try:
+        with instruments.timer("ffmpeg"):
+            process = subprocess.Popen(command)
+            returnCode = process.wait() #blocks without using the CPU until ffmpeg exits
+        return returnCode
+    except subprocess.CalledProcessError as e:
+        instruments.log(Verbosity.QUIET, f"Ran into some errors: {e}")
+
+def findSpeechStarts(markers, numFramesToCheck):#markers are Speech or Landmark objects, in timestamp order
+    speechStarts = []
+    detectionWindow = deque(maxlen=numFramesToCheck)
+    for frame in markers:        
+        #---detect the point at which speaking starts after a pause
+        if len(detectionWindow) == numFramesToCheck and all(i == False for i in detectionWindow) and frame.speaking == True:#the False means notSpeaking and True means speaking
+            instruments.log(Verbosity.DETAILED, f"Speaking started after a silence at: {frame.timestamp} {frame.speaking}")
+            speechStarts.append(frame.timestamp)
+        detectionWindow.append(frame.speaking)
+    return speechStarts
+
+def findSpeechStartTimes(timestamps, speaking, numFramesToCheck):#the same as findSpeechStarts, for arrays of timestamps and speaking flags
+    speaking = np.asarray(speaking, dtype=bool)
+    if len(speaking) <= numFramesToCheck:
+        return []
+    silentSoFar = np.concatenate(([0], np.cumsum(~speaking)))
+    silentBefore = silentSoFar[numFramesToCheck:-1] - silentSoFar[:-numFramesToCheck - 1] #silent frames among the numFramesToCheck before each frame from numFramesToCheck onwards
+    speechStarts = numFramesToCheck + np.flatnonzero(speaking[numFramesToCheck:] & (silentBefore == numFramesToCheck))
+    return np.asarray(timestamps)[speechStarts].tolist()
+
+def searchNearbyAudioTimestamps(audioCrucialPoints, videoTimestamp, maxOffset=1.5):#audio video may be out of sync by a max of maxOffset seconds. audioCrucialPoints must be in timestamp order
+    #---binary search for the audio points on either side of the video timestamp; only those two can be the closest one
+    nearestAudioIndex = None #audio index of speech that's closest to the video timestamp
+    closestValue = 999
+    insertionIndex = bisect_left(audioCrucialPoints, videoTimestamp)
+    for i in (insertionIndex - 1, insertionIndex):
+        if 0 <= i < len(audioCrucialPoints):
+            val = abs(videoTimestamp - audioCrucialPoints[i])
+            if val <= maxOffset and val < closestValue:#within range of the video timestamp offset allowed, and the closest offset detected
+                closestValue = val
+                nearestAudioIndex = i
+    return nearestAudioIndex
+
+def applyOffset(videoSource, offset, outputFile):#writes outputFile with the audio of videoSource delayed by offset seconds (negative values advance it). Streams are copied, not re-encoded. Returns ffmpeg's exit code
+    command = f"ffmpeg -hide_banner -loglevel error -y -i {shlex.quote(videoSource)} -itsoffset {offset} -i {shlex.quote(videoSource)} -map 0:v -map 1:a -c copy {shlex.quote(outputFile)}"  #https://superuser.com/questions/982342/in-ffmpeg-how-to-delay-only-the-audio-of-a-mp4-video-without-converting-the-au
+    return runCommand(command)
+
+class SyncPipeline:
+    """Runs the audio side (ffmpeg audio decoding + VAD) and the video side (face mesh landmarking) at the same time and joins their results."""
+    def __init__(self, videoSource, nonSpeechFilterLevel=1, numVideoWorkers=1, cache=None, workingDirectory=None) -> None:
+        self.videoSource = videoSource
+        self.nonSpeechFilterLevel = nonSpeechFilterLevel
+        self.candidateFilterLevels = () #further VAD aggressiveness levels evaluated in the same pass over the audio. estimateOffset() then uses whichever level correlates best with the lips
+        self.chosenFilterLevel = None
+        self.numVideoWorkers = numVideoWorkers
+        self.videoSettings = {} #VideoFaceProcessor attributes to override, e.g. {"keyframeInterval": 5} or {"decodeBackend": "ffmpeg", "analysisFps": 15, "analysisWidth": 640}
+        self.cache = cache #ResultCache shared by the VAD and the face processor, or None to always recompute
+        self.streamAudio = True #decode the audio through an ffmpeg pipe straight into the VAD. False writes a WAV file first and loads it
+        self.workingDirectory = workingDirectory #where intermediate files (extracted WAV, VAD chunks) are written. None writes the WAV next to the video and the chunks to the current directory
+        self.waveExtension = ".wav"
+        self.audioFile = os.path.splitext(videoSource)[0] + self.waveExtension
+        if workingDirectory is not None:
+            self.audioFile = os.path.join(workingDirectory, os.path.basename(self.audioFile))
+        self.audioMarkers = None #SpeechStore
+        self.audioMarkersByLevel = {} #{VAD level: SpeechStore}
+        self.videoMarkers = None #deque of Landmark objects
+        self.stageDurations = {} #{stageName: seconds}
+        self.numFramesToCheck = 15 #frames of silence that must precede speech for it to count as speech starting after a pause
+        self.maxOffset = 1.5 #audio video may be out of sync by a max of these many seconds
+        self.videoContextSeconds = 2 #in audio guided mode, how much video before and after each searched window is also landmarked, so that the silences around it are detected as in a full pass
+        self.faceProcessor = None
+
+    def run(self):
+        #---the audio side mostly waits on ffmpeg, so it runs alongside the video side instead of adding onto it. The face mesh releases the GIL while processing, and parallel video mode uses its own processes anyway
+        with self.stage("total"), ThreadPoolExecutor(max_workers=2) as executor:
+            audioFuture = executor.submit(self.analyseAudio)
+            videoFuture = executor.submit(self.analyseVideo)
+            self.audioMarkers = audioFuture.result()
+            self.videoMarkers = videoFuture.result()
+        self.reportStageDurations()
+        return self.audioMarkers, self.videoMarkers
+
+    def runAudioGuided(self):
+        """Runs the VAD first and then landmarks only the video around the points where the audio shows speech starting after a pause, since only video speech starts within maxOffset of those can be matched."""
+        with self.stage("total"):
+            self.audioMarkers = self.analyseAudio()
+            instruments.log(Verbosity.DETAILED, '--------- audio')
+            audioSpeechStarts = findSpeechStartTimes(self.audioMarkers.timestamps, self.audioMarkers.speaking, self.numFramesToCheck)
+            margin = self.maxOffset + self.videoContextSeconds
+            timeRanges = [(audioTimestamp - margin, audioTimestamp + margin) for audioTimestamp in audioSpeechStarts]
+            instruments.log(Verbosity.NORMAL, "Processing video")
+            with self.stage("videoLandmarks"):
+                self.faceProcessor = self.createFaceProcessor()
+                self.faceProcessor.runOnTimeRanges(timeRanges)
+            self.videoMarkers = self.faceProcessor.faces.get(self.faceProcessor.hardCodedFaceID, [])
+        self.reportStageDurations()
+        return self.audioMarkers, self.videoMarkers
+
+    def analyseAudio(self):
+        vad = VoiceActivityDetector(self.cache)
+        if self.workingDirectory is not None:
+            vad.segmentDirectory = self.workingDirectory
+        if self.streamAudio:
+            #---Analyze audio to detect speech, while ffmpeg decodes it
+            instruments.log(Verbosity.NORMAL, "Processing audio")
+            with self.stage("voiceActivityDetection"):
+                vad.runOnStream(self.videoSource, self.nonSpeechFilterLevel, otherLevels=self.candidateFilterLevels)
+            self.audioMarkersByLevel = vad.speechByLevel
+            return vad.getSpeechDetectedSections()
+        with self.stage("audioExtraction"):
+            #---Create an audio file from the video file
+            command = f"ffmpeg -hide_banner -loglevel error -y -i {shlex.quote(self.videoSource)} -vn -ac 1 {shlex.quote(self.audioFile)}"
+            runCommand(command)
+        #---Analyze audio to detect speech
+        instruments.log(Verbosity.NORMAL, "Processing audio")
+        with self.stage("voiceActivityDetection"):
+            vad.run(self.audioFile, self.nonSpeechFilterLevel, otherLevels=self.candidateFilterLevels)
+        self.audioMarkersByLevel = vad.speechByLevel
+        return vad.getSpeechDetectedSections()
+
+    def analyseVideo(self):
+        #---Analyze lip movements to detect silences
+        instruments.log(Verbosity.NORMAL, "Processing video")
+        with self.stage("videoLandmarks"):
+            self.faceProcessor = self.createFaceProcessor()
+            self.faceProcessor.run()
+        return self.faceProcessor.getDetectedSilences()
+
+    def createFaceProcessor(self):
+        faceProcessor = VideoFaceProcessor(self.videoSource, numWorkers=self.numVideoWorkers, cache=self.cache)
+        for settingName, value in self.videoSettings.items():
+            setattr(faceProcessor, settingName, value)
+        return faceProcessor
+
+    def estimateOffset(self):
+        """Returns (offset in seconds, confidence) from cross-correlating the audio speech signal with the video lip separation signal.
+        With candidateFilterLevels, every evaluated VAD level is tried and the most confident one is kept (as chosenFilterLevel and audioMarkers)."""
+        with self.stage("offsetEstimation"):
+            estimator = OffsetEstimator(self.maxOffset)
+            landmarks = self.faceProcessor.getLandmarkStore()
+            markersByLevel = self.audioMarkersByLevel or {self.nonSpeechFilterLevel: self.audioMarkers}
+            if len(landmarks) < 2:#no face was found, or in audio guided mode the audio had no speech starting after a pause, so no video was landmarked
+                instruments.log(Verbosity.NORMAL, "Too few face landmarks to estimate the offset")
+                self.chosenFilterLevel = self.nonSpeechFilterLevel
+                self.audioMarkers = markersByLevel.get(self.nonSpeechFilterLevel, self.audioMarkers)
+                return 0.0, 0.0
+            best = None
+            for level, markers in markersByLevel.items():
+                offset, confidence = estimator.estimate(markers.timestamps, markers.speaking, landmarks.timestamps, landmarks.lipSeparation)
+                instruments.log(Verbosity.DETAILED, f"VAD level {level}: offset {offset:.3f}s, confidence {confidence:.2f}")
+                if best is None or confidence > best[2]:
+                    best = (level, offset, confidence)
+            self.chosenFilterLevel, offset, confidence = best
+            self.audioMarkers = markersByLevel[self.chosenFilterLevel]
+        return offset, confidence
+
+    @contextmanager
+    def stage(self, stageName):#times a stage into self.stageDurations as well as the shared instrumentation
+        startTime = time.perf_counter()
+        with instruments.stage(stageName):
+            yield
+        self.stageDurations[stageName] = time.perf_counter() - startTime
+
+    def reportStageDurations(self):
+        instruments.log(Verbosity.NORMAL, "Stage durations:")
+        for stageName, seconds in self.stageDurations.items():
+            instruments.log(Verbosity.NORMAL, f"  {stageName}: {seconds:.2f}s")
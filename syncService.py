@@ -0,0 +1,156 @@
+import argparse
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from faceDetector import VideoFaceProcessor
+from instrumentation import instruments, Verbosity
+from resultCache import ResultCache
+from syncPipeline import SyncPipeline, applyOffset
+
+class SyncService:
+    """Long running sync service, so that many short clips don't each pay for starting Python, importing mediapipe and cv2 and building a face mesh graph.
+    Jobs are posted over a local HTTP endpoint and queued for a pool of worker threads. One face mesh per worker thread is built before the service starts listening, and each job borrows one for as long as it runs, resetting it first so no tracking carries over from one video to the next.
+    Endpoints: POST /jobs with {"source": video file, "output": synced file (optional), "filterLevel": VAD level (optional)} returns {"id": jobID}. GET /jobs/<jobID> returns the job's record, GET /jobs all of them.
+    """
+    def __init__(self, host="127.0.0.1", port=8765, numWorkers=2, nonSpeechFilterLevel=1, cacheDirectory=None, scratchRoot=None) -> None:
+        self.host = host #only local clients by default, since jobs name files on this machine
+        self.port = port
+        self.numWorkers = numWorkers
+        self.nonSpeechFilterLevel = nonSpeechFilterLevel
+        self.cache = ResultCache(cacheDirectory) if cacheDirectory is not None else None
+        self.scratchRoot = scratchRoot
+        self.outputSuffix = "_sync"
+        self.jobs = {} #{jobID: record}
+        self.lock = threading.Lock()
+        self.faceMeshes = queue.Queue() #the face meshes not in use by a job, since one can't be used by two threads at once. There is one per worker thread, so a job never waits for one
+        self.executor = None
+        self.server = None
+
+    def warmUp(self):#builds the face meshes up front, so that the first jobs don't pay for it and a failure to build one stops the service before it accepts jobs
+        for worker in range(self.numWorkers):
+            self.faceMeshes.put(VideoFaceProcessor(None).openFaceMesh())
+
+    def submit(self, source, output=None, nonSpeechFilterLevel=None):
+        jobID = uuid.uuid4().hex
+        if output is None:
+            pathWithoutExtension, extension = os.path.splitext(source)
+            output = pathWithoutExtension + self.outputSuffix + extension
+        record = {"id": jobID, "source": source, "output": output, "filterLevel": self.nonSpeechFilterLevel if nonSpeechFilterLevel is None else nonSpeechFilterLevel, "status": "queued", "submitted": time.time()}
+        with self.lock:
+            self.jobs[jobID] = record
+        try:
+            self.executor.submit(self.runJob, jobID)
+        except RuntimeError:#the executor is shutting down, so the job would never leave the queue
+            with self.lock:
+                del self.jobs[jobID]
+            raise
+        return jobID
+
+    def runJob(self, jobID):
+        record = self.updateJob(jobID, status="running")
+        startTime = time.perf_counter()
+        scratchDirectory = tempfile.mkdtemp(prefix="syncJob-", dir=self.scratchRoot)
+        faceMesh = self.faceMeshes.get()
+        try:
+            faceMesh.reset() #starts the graph over, since its face tracking still follows the last frame of the previous job
+            pipeline = SyncPipeline(record["source"], record["filterLevel"], numVideoWorkers=1, cache=self.cache, workingDirectory=scratchDirectory) #jobs are already spread across the worker threads
+            pipeline.videoSettings = {"faceMesh": faceMesh}
+            pipeline.run()
+            offset, confidence = pipeline.estimateOffset()
+            os.makedirs(os.path.dirname(record["output"]) or ".", exist_ok=True)
+            if applyOffset(record["source"], offset, record["output"]) != 0:
+                raise RuntimeError(f"ffmpeg could not write {record['output']}")
+            record = self.updateJob(jobID, status="done", offset=offset, confidence=confidence, seconds=time.perf_counter() - startTime)
+        except Exception as e:#a failed job is reported to the client, without stopping the service
+            record = self.updateJob(jobID, status="failed", error=repr(e), seconds=time.perf_counter() - startTime)
+        finally:
+            self.faceMeshes.put(faceMesh)
+            shutil.rmtree(scratchDirectory, ignore_errors=True)
+        instruments.log(Verbosity.NORMAL, f"{record['status']}: {record['source']}")
+
+    def updateJob(self, jobID, **changes):
+        with self.lock:
+            self.jobs[jobID].update(changes)
+            return dict(self.jobs[jobID])
+
+    def jobRecords(self, jobID=None):#one job's record (None if there is no such job), or a list of all of them
+        with self.lock:
+            if jobID is None:
+                return [dict(record) for record in self.jobs.values()]
+            return dict(self.jobs[jobID]) if jobID in self.jobs else None
+
+    def serve(self):
+        self.warmUp()
+        self.executor = ThreadPoolExecutor(max_workers=self.numWorkers)
+        self.server = ThreadingHTTPServer((self.host, self.port), SyncRequestHandler)
+        self.server.service = self
+        instruments.log(Verbosity.QUIET, f"Sync service listening on http://{self.host}:{self.server.server_address[1]} with {self.numWorkers} workers")
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            self.executor.shutdown(wait=True)
+            while not self.faceMeshes.empty():
+                self.faceMeshes.get().close()
+
+    def shutdown(self):#from another thread. Jobs already queued are finished first
+        self.server.shutdown()
+
+class SyncRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            return self.sendJson(404, {"error": "not found"})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            source = request["source"]
+        except (ValueError, KeyError, TypeError):
+            return self.sendJson(400, {"error": "expected a JSON object with a source"})
+        if not os.path.isfile(source):
+            return self.sendJson(400, {"error": f"no such file: {source}"})
+        try:
+            jobID = self.server.service.submit(source, request.get("output"), request.get("filterLevel"))
+        except RuntimeError:
+            return self.sendJson(503, {"error": "the service is shutting down"})
+        self.sendJson(202, {"id": jobID})
+
+    def do_GET(self):
+        parts = [part for part in self.path.split("/") if part]
+        if parts == ["jobs"]:
+            return self.sendJson(200, self.server.service.jobRecords())
+        if len(parts) == 2 and parts[0] == "jobs":
+            record = self.server.service.jobRecords(parts[1])
+            return self.sendJson(200, record) if record is not None else self.sendJson(404, {"error": "no such job"})
+        self.sendJson(404, {"error": "not found"})
+
+    def sendJson(self, statusCode, body):
+        content = json.dumps(body).encode()
+        self.send_response(statusCode)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):#requests are logged through the instrumentation, instead of to stderr
+        instruments.log(Verbosity.DETAILED, f"{self.address_string()} {format % args}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve sync jobs over a local HTTP endpoint, keeping the face mesh loaded between jobs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=2, help="number of jobs run at the same time")
+    parser.add_argument("--filter-level", type=int, default=1, choices=range(4), help="default VAD aggressiveness about filtering out non-speech")
+    parser.add_argument("--cache", default=None, help="result cache directory (default: no cache)")
+    parser.add_argument("--scratch", default=None, help="directory for per job scratch directories")
+    arguments = parser.parse_args()
+    service = SyncService(arguments.host, arguments.port, arguments.workers, arguments.filter_level, arguments.cache, arguments.scratch)
+    try:
+        service.serve()
+    except KeyboardInterrupt:
+        pass
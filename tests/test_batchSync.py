@@ -0,0 +1,62 @@
+import json
+import os
+import pytest
+
+pytest.importorskip("cv2")
+pytest.importorskip("mediapipe")
+from batchSync import BatchSync
+
+def makeFiles(root, *relativePaths):
+    for relativePath in relativePaths:
+        path = os.path.join(root, relativePath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fileHandle:
+            fileHandle.write(relativePath.encode())
+
+def outputs(batch):
+    return [os.path.relpath(outputFile, batch.outputDirectory) for videoFile, outputFile in batch.findVideos()]
+
+def testOutputsMirrorTheLayoutBelowOneSourceDirectory(tmp_path):
+    makeFiles(tmp_path, "videos/a.mp4", "videos/day2/a.mp4", "videos/notes.txt")
+    batch = BatchSync([str(tmp_path / "videos")], str(tmp_path / "synced"))
+    assert outputs(batch) == ["a_sync.mp4", os.path.join("day2", "a_sync.mp4")]
+
+def testEquallyNamedFilesFromDifferentSourcesDontCollide(tmp_path):
+    makeFiles(tmp_path, "first/a.mp4", "second/a.mp4", "third/clip/a.mp4", "fourth/clip/a.mp4")
+    batch = BatchSync([str(tmp_path / "first" / "a.mp4"), str(tmp_path / "second"), str(tmp_path / "third" / "clip"), str(tmp_path / "fourth")], str(tmp_path / "synced"))
+    names = outputs(batch)
+    assert len(set(names)) == len(names) == 4
+    assert names[0] == os.path.join("first", "a_sync.mp4")
+
+def testSingleFileKeepsItsName(tmp_path):
+    makeFiles(tmp_path, "videos/a.mp4")
+    batch = BatchSync([str(tmp_path / "videos" / "a.mp4")], str(tmp_path / "synced"))
+    assert outputs(batch) == ["a_sync.mp4"]
+
+def testFileGivenTwiceIsSyncedOnce(tmp_path):
+    makeFiles(tmp_path, "videos/a.mp4")
+    batch = BatchSync([str(tmp_path / "videos"), str(tmp_path / "videos" / "a.mp4")], str(tmp_path / "synced"))
+    assert outputs(batch) == ["a_sync.mp4"]
+
+def testOutputDirectoryInsideASourceIsSkipped(tmp_path):
+    makeFiles(tmp_path, "videos/a.mp4", "videos/synced/a_sync.mp4")
+    batch = BatchSync([str(tmp_path / "videos")], str(tmp_path / "videos" / "synced"))
+    assert outputs(batch) == ["a_sync.mp4"]
+
+def testResumeSkipsOnlyFinishedUnchangedFiles(tmp_path):
+    makeFiles(tmp_path, "videos/done.mp4", "videos/failed.mp4", "videos/changed.mp4", "videos/new.mp4")
+    batch = BatchSync([str(tmp_path / "videos")], str(tmp_path / "synced"))
+    os.makedirs(batch.outputDirectory)
+    videoFile = lambda name: str(tmp_path / "videos" / name)
+    batch.recordJob(dict(batch.jobIdentity(videoFile("done.mp4")), status="done"))
+    batch.recordJob(dict(batch.jobIdentity(videoFile("failed.mp4")), status="failed", error="RuntimeError()"))
+    batch.recordJob(dict(batch.jobIdentity(videoFile("changed.mp4")), status="done"))
+    with open(batch.manifestFile, 'a') as manifest:
+        manifest.write('{"source": "cut short by an interrup')
+    with open(videoFile("changed.mp4"), 'ab') as fileHandle:
+        fileHandle.write(b"edited since it was synced")
+    finishedJobs = batch.readFinishedJobs()
+    pendingFiles = sorted(os.path.basename(videoFile) for identity, videoFile, outputFile in batch.findPendingJobs(finishedJobs))
+    assert pendingFiles == ["changed.mp4", "failed.mp4", "new.mp4"]
+    with open(batch.manifestFile) as manifest:
+        assert json.loads(manifest.readline())["status"] == "done"
@@ -0,0 +1,104 @@
+import math
+import types
+from collections import deque
+import numpy as np
+import pytest
+
+pytest.importorskip("cv2")
+pytest.importorskip("mediapipe")
+from faceDetector import LandmarkStore, VideoFaceProcessor
+
+def referenceSilencePhases(lipSeparation, pauseDuration, mouthOpeningThreshold=1):
+    #---the original sliding window loop
+    speaking = [True] * len(lipSeparation)
+    pastFew = deque(maxlen=pauseDuration)
+    for i in range(len(lipSeparation)):
+        pastFew.append(lipSeparation[i])
+        if all(separation < mouthOpeningThreshold for separation in pastFew):
+            for j in range(i, i - len(pastFew), -1):
+                speaking[j] = False
+    return speaking
+
+def landmarksWithLipSeparation(faceProcessor, lipSeparation):
+    landmarks = LandmarkStore.fromArrays(faceProcessor.pointCodes, np.arange(len(lipSeparation)) / 30, np.zeros((len(lipSeparation), len(faceProcessor.pointCodes), 3)))
+    landmarks.lipSeparation = np.array(lipSeparation, dtype=np.float64)
+    return landmarks
+
+@pytest.mark.parametrize("mouthClosed", [
+    [],
+    [1] * 3, #a short closed run at the very start counts as a pause
+    [0] * 5 + [1] * 6 + [0] * 5, #one frame short of a pause
+    [0] * 5 + [1] * 7 + [0] * 5, #exactly a pause
+    [0] * 5 + [1] * 6, #a short closed run at the end
+    [0] * 3 + [1] * 10, #a pause at the end
+    [1] * 2 + [0] + [1] * 8 + [0, 1, 0] + [1] * 7,
+])
+def testSilencePhasesMatchReferenceLoop(mouthClosed):
+    faceProcessor = VideoFaceProcessor(None)
+    faceProcessor.setFrameRate(30) #a pause is 7 frames
+    lipSeparation = [0.5 if closed else 3.0 for closed in mouthClosed]
+    landmarks = landmarksWithLipSeparation(faceProcessor, lipSeparation)
+    faceProcessor.determineSilencePhases(landmarks)
+    assert landmarks.speaking.tolist() == referenceSilencePhases(lipSeparation, faceProcessor.pauseDuration)
+
+@pytest.mark.parametrize("fps", [1, 15, 30, 60])
+def testSilencePhasesMatchReferenceLoopOnRandomInput(fps):
+    faceProcessor = VideoFaceProcessor(None)
+    faceProcessor.setFrameRate(fps)
+    randomGenerator = np.random.default_rng(fps)
+    for trial in range(50):
+        lipSeparation = randomGenerator.choice([0.5, 3.0], size=randomGenerator.integers(0, 120), p=[0.7, 0.3]).tolist()
+        landmarks = landmarksWithLipSeparation(faceProcessor, lipSeparation)
+        faceProcessor.determineSilencePhases(landmarks)
+        assert landmarks.speaking.tolist() == referenceSilencePhases(lipSeparation, faceProcessor.pauseDuration)
+
+def testLipSeparationMatchesReferenceDistances():
+    faceProcessor = VideoFaceProcessor(None)
+    faceProcessor.setFrameRate(30)
+    points = np.random.default_rng(0).random((20, len(faceProcessor.pointCodes), 3))
+    landmarks = LandmarkStore.fromArrays(faceProcessor.pointCodes, np.arange(20) / 30, points)
+    faceProcessor.analyseLipMovement(landmarks)
+    for frame, landmark in enumerate(landmarks):
+        faceHeight = math.dist(landmark.points[faceProcessor.topOfHead], landmark.points[faceProcessor.tipOfChin])
+        averageDistance = sum(math.dist(landmark.points[upper], landmark.points[lower]) for upper, lower in zip(faceProcessor.upperLipPoints, faceProcessor.lowerLipPoints)) / len(faceProcessor.upperLipPoints)
+        assert landmarks.lipSeparation[frame] == pytest.approx(averageDistance * 100 / faceHeight, rel=1e-5)
+
+@pytest.mark.parametrize("numFrames, numWorkers, expectedRanges", [
+    (180, 3, [(0, None)]), #too short to be worth splitting
+    (600, 32, [(0, 150), (150, 300), (300, 450), (450, None)]), #capped at ranges of 5 seconds
+    (3000, 4, [(0, 750), (750, 1500), (1500, 2250), (2250, None)]),
+    (0, 4, [(0, None)]),
+])
+def testFrameRangesAreLongerThanTheirWarmUp(numFrames, numWorkers, expectedRanges):
+    faceProcessor = VideoFaceProcessor(None, numWorkers=numWorkers)
+    faceProcessor.setFrameRate(30)
+    assert faceProcessor.splitIntoFrameRanges(numFrames) == expectedRanges
+
+class BrightnessFaceMesh:
+    #---a stateless stand-in for the face mesh, whose landmarks only depend on the frame's brightness, so every frame range gives the serial pass's landmarks
+    def process(self, image):
+        brightness = float(image.mean()) / 255
+        face = types.SimpleNamespace(landmark=[types.SimpleNamespace(x=brightness, y=pointCode / 478, z=0.0) for pointCode in range(478)])
+        return types.SimpleNamespace(multi_face_landmarks=[face])
+
+def testMergedFrameRangesMatchTheSerialPass(tmp_path):
+    cv2 = pytest.importorskip("cv2")
+    videoPath = str(tmp_path / "brightness.avi")
+    writer = cv2.VideoWriter(videoPath, cv2.VideoWriter_fourcc(*"MJPG"), 10, (64, 48))
+    for frame in range(95):
+        writer.write(np.full((48, 64, 3), (frame * 37) % 256, np.uint8))
+    writer.release()
+    faceProcessor = VideoFaceProcessor(videoPath, numWorkers=4)
+    faceProcessor.faceMesh = BrightnessFaceMesh()
+    numFrames = faceProcessor.readVideoProperties()
+    faceProcessor.minimumRangeLength = 2 #ranges of at least 20 frames, each warmed up on the 10 frames before it
+    frameRanges = faceProcessor.splitIntoFrameRanges(numFrames)
+    assert len(frameRanges) == 4
+    faceProcessor.numWorkers = 1 #the worker processes couldn't use the stand-in face mesh, so the ranges are processed one after the other
+    merged = LandmarkStore(faceProcessor.pointCodes)
+    for rangeLandmarks in faceProcessor.processFrameRanges(frameRanges):
+        merged.extend(rangeLandmarks)
+    serial = faceProcessor.processFrameRanges([(0, None)])[0]
+    assert len(serial) == 95
+    np.testing.assert_array_equal(merged.timestamps, serial.timestamps)
+    np.testing.assert_array_equal(merged.points, serial.points)
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+from lipTracker import LipTracker
+
+width, height = 320, 240
+
+def createTracker(**settings):
+    return LipTracker([0, 1], [2, 3, 4], [5, 6, 7], **settings) #top of head and tip of chin, then the upper and lower lip points
+
+def facePoints(lipGap=0.04, centre=(0.5, 0.6)):
+    #---normalized points of a face 0.6 of the frame high, with its mouth lipGap open
+    x, y = centre
+    points = [[x, y - 0.4, 0], [x, y + 0.2, 0]]
+    points += [[x + dx, y - lipGap / 2, 0] for dx in (-0.05, 0, 0.05)]
+    points += [[x + dx, y + lipGap / 2, 0] for dx in (-0.05, 0, 0.05)]
+    return np.array(points, dtype=np.float32)
+
+def noiseTexture(seed=0):
+    noise = np.random.default_rng(seed).integers(0, 256, (height, width)).astype(np.uint8)
+    return cv2.GaussianBlur(noise, (0, 0), 2)
+
+def shifted(grey, dx, dy):
+    return cv2.warpAffine(grey, np.float32([[1, 0, dx], [0, 1, dy]]), (width, height), borderMode=cv2.BORDER_REFLECT)
+
+def testTrackingFollowsAShiftedTexture():
+    tracker = createTracker()
+    grey = noiseTexture()
+    points = facePoints()
+    tracker.startFrom(grey, points)
+    trackedPoints = None
+    for frame in range(1, 4):
+        trackedPoints = tracker.track(shifted(grey, 1.5 * frame, -1 * frame))
+        assert trackedPoints is not None
+    motion = np.array([4.5 / width, -3 / height])
+    np.testing.assert_allclose(trackedPoints[:, :2], points[:, :2] + motion, atol=0.2 / width) #the head points move with the lips
+    assert tracker.lipSeparation(trackedPoints) == pytest.approx(tracker.lipSeparation(points), abs=0.1)
+    assert tracker.framesSinceKeyframe == 3
+
+def testTrackingIsLostWhenTheMouthLeavesTheFrame():
+    tracker = createTracker()
+    grey = noiseTexture()
+    tracker.startFrom(grey, facePoints(centre=(1.3, 0.6))) #the lips are beyond the right edge
+    assert tracker.track(grey) is None
+
+def testTrackingIsLostWhenTheMouthChangesBeyondRecognition():
+    tracker = createTracker()
+    tracker.startFrom(noiseTexture(0), facePoints())
+    assert tracker.track(noiseTexture(1)) is None #fails the forward-backward check
+    assert tracker.framesSinceKeyframe == 0
+
+def testKeyframesAreNeededEveryKeyframeInterval():
+    tracker = createTracker(maximumKeyframeInterval=3)
+    grey = noiseTexture()
+    assert tracker.needsKeyframe() #nothing to track from yet
+    tracker.startFrom(grey, facePoints())
+    schedule = []
+    for frame in range(4):
+        schedule.append(tracker.needsKeyframe())
+        tracker.track(grey)
+    assert schedule == [False, False, False, True]
+    tracker.startFrom(grey, facePoints())
+    assert not tracker.needsKeyframe()
+    tracker.reset()
+    assert tracker.needsKeyframe()
+
+def testKeyframeIntervalHalvesOnDriftAndRecovers():
+    tracker = createTracker(maximumKeyframeInterval=8, lipSeparationTolerance=0.3)
+    grey = noiseTexture()
+    points = facePoints(lipGap=0.04) #a lip separation of 4/0.6 = 6.67
+    driftedPoints = facePoints(lipGap=0.04 + 0.6 * 0.5 / 100) #0.5 more, beyond the tolerance
+    closePoints = facePoints(lipGap=0.04 + 0.6 * 0.2 / 100) #0.2 more, within the tolerance
+    tracker.startFrom(grey, points)
+    assert tracker.keyframeInterval == 8 #the first keyframe has no tracking to check
+    intervals = []
+    for trackedPoints in [driftedPoints] * 4 + [closePoints] * 9:
+        tracker.startFrom(grey, points, trackedPoints)
+        intervals.append(tracker.keyframeInterval)
+    assert intervals == [4, 2, 1, 1, 2, 3, 4, 5, 6, 7, 8, 8, 8]
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("cv2")
+pytest.importorskip("mediapipe")
+pytest.importorskip("webrtcvad")
+from faceDetector import VideoFaceProcessor
+from longVideoSync import WindowedSync
+
+def windowedSync(offsetCurve):
+    sync = WindowedSync("long.mp4")
+    sync.offsetCurve = offsetCurve
+    return sync
+
+def testUnreliableWindowsTakeTheNearestReliableOffset():
+    centres, offsets = windowedSync([(30, 0.4, 0.9), (100, 1.0, 0.05), (150, -0.2, 0.9)]).correctedOffsets()
+    assert centres.tolist() == [30, 100, 150]
+    assert offsets.tolist() == [0.4, -0.2, -0.2]
+
+def testNoReliableWindowsMeansNoCorrection():
+    centres, offsets = windowedSync([(30, 0.4, 0.1), (90, -0.3, 0.0)]).correctedOffsets()
+    assert offsets.tolist() == [0.0, 0.0]
+
+def testPiecewiseFilterDelaysForPositiveAndAdvancesForNegativeOffsets():
+    #---output [0, 60) plays the audio from -0.5s (half a second of silence first), output [60, end) the audio from 60.25s
+    assert windowedSync([(30, 0.5, 0.9), (90, -0.25, 0.9)]).buildPiecewiseFilter() == (
+        "[0:a]asplit=2[s0][s1];"
+        "[s0]atrim=start=0.000000:end=59.500000,asetpts=PTS-STARTPTS,adelay=500:all=1[a0];"
+        "[s1]atrim=start=60.250000,asetpts=PTS-STARTPTS[a1];"
+        "[a0][a1]concat=n=2:v=0:a=1[aout]")
+
+def testPiecewiseFilterUsesCorrectedOffsetsForUnreliableWindows():
+    assert windowedSync([(30, -0.1, 0.9), (90, 1.2, 0.0), (150, -0.1, 0.9)]).buildPiecewiseFilter() == (
+        "[0:a]asplit=3[s0][s1][s2];"
+        "[s0]atrim=start=0.100000:end=60.100000,asetpts=PTS-STARTPTS[a0];"
+        "[s1]atrim=start=60.100000:end=120.100000,asetpts=PTS-STARTPTS[a1];"
+        "[s2]atrim=start=120.100000,asetpts=PTS-STARTPTS[a2];"
+        "[a0][a1][a2]concat=n=3:v=0:a=1[aout]")
+
+def testStretchFilterForAGrowingPositiveOffset():
+    #---offset = 0.2 + 0.001 t: the audio plays at tempo 0.999, after 0.2 / 0.999 seconds of silence
+    centres = [30, 90, 150]
+    assert windowedSync([(centre, 0.2 + 0.001 * centre, 1.0) for centre in centres]).buildStretchFilter() == "[0:a]atempo=0.999000000,adelay=200:all=1[aout]"
+
+def testStretchFilterForAGrowingNegativeOffset():
+    #---offset = -0.3 - 0.0005 t: the first 0.3s of audio are dropped and the rest plays at tempo 1.0005
+    centres = [30, 90, 150]
+    assert windowedSync([(centre, -0.3 - 0.0005 * centre, 1.0) for centre in centres]).buildStretchFilter() == "[0:a]atrim=start=0.300000,asetpts=PTS-STARTPTS,atempo=1.000500000[aout]"
+
+def testStretchFilterForOneWindow():
+    assert windowedSync([(0.0, -0.4, 0.9)]).buildStretchFilter() == "[0:a]atrim=start=0.400000,asetpts=PTS-STARTPTS,atempo=1.000000000[aout]"
+
+@pytest.mark.parametrize("numFrames, fps", [(0, 30.0), (900, 0.0)])
+def testUnknownLengthIsAnalysedAsOneWindow(monkeypatch, numFrames, fps):
+    def readVideoProperties(faceProcessor):
+        faceProcessor.setFrameRate(fps)
+        return numFrames
+    monkeypatch.setattr(VideoFaceProcessor, "readVideoProperties", readVideoProperties)
+    windows = []
+    sync = WindowedSync("long.mp4")
+    monkeypatch.setattr(sync, "analyseWindow", lambda faceProcessor, startSeconds, endSeconds: windows.append((startSeconds, endSeconds)) or (0.3, 0.8))
+    assert sync.run() == [(0.0, 0.3, 0.8)]
+    assert windows == [(0, None)]
+    assert sync.buildPiecewiseFilter() == "[0:a]asplit=1[s0];[s0]atrim=start=0.000000,asetpts=PTS-STARTPTS,adelay=300:all=1[a0];[a0]concat=n=1:v=0:a=1[aout]"
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+from offsetEstimator import OffsetEstimator
+
+def speechPattern(seed, durationSeconds):#returns a function of time giving alternating speech and pauses of random lengths
+    randomGenerator = np.random.default_rng(seed)
+    boundaries = np.cumsum(randomGenerator.uniform(0.3, 1.5, size=int(durationSeconds) + 10))
+    return lambda times: (np.searchsorted(boundaries, times) % 2 == 0)
+
+@pytest.mark.parametrize("offset", [0.0, 0.4, -0.4, 1.2, -1.2, 0.233])
+def testEstimateRecoversInjectedOffset(offset):
+    speaking = speechPattern(1, 60)
+    audioTimestamps = np.arange(0, 60, 0.03)
+    videoTimestamps = np.arange(0, 60, 1 / 30)
+    lipSeparation = np.where(speaking(videoTimestamps - offset), 4.0, 0.5) #the lips move offset seconds after the audio, as when the audio is early
+    estimatedOffset, confidence = OffsetEstimator(1.5).estimate(audioTimestamps, speaking(audioTimestamps), videoTimestamps, lipSeparation)
+    assert estimatedOffset == pytest.approx(offset, abs=0.02)
+    assert confidence > 0.8
+
+@pytest.mark.parametrize("offset", [0.7, -0.7])
+def testEstimateWithPartialCoverage(offset):
+    speaking = speechPattern(2, 60)
+    audioTimestamps = np.arange(0, 60, 0.03)
+    videoTimestamps = np.arange(20, 45, 1 / 30) #the face is only visible for part of the audio
+    lipSeparation = np.where(speaking(videoTimestamps - offset), 4.0, 0.5)
+    estimatedOffset, confidence = OffsetEstimator(1.5).estimate(audioTimestamps, speaking(audioTimestamps), videoTimestamps, lipSeparation)
+    assert estimatedOffset == pytest.approx(offset, abs=0.02)
+    assert confidence > 0.8
+
+def testEstimateWithTooFewSamples():
+    assert OffsetEstimator().estimate([0.0], [True], [0.0, 0.1], [1.0, 2.0]) == (0.0, 0.0)
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("cv2")
+pytest.importorskip("mediapipe")
+pytest.importorskip("webrtcvad")
+from faceDetector import LandmarkStore, VideoFaceProcessor
+from progressiveSync import ProgressiveSync
+from syncPipeline import findSpeechStartTimes
+
+def facePoints(faceProcessor, mouthClosed):#face points whose lips are shut on the frames where mouthClosed is True
+    columns = {pointCode: column for column, pointCode in enumerate(faceProcessor.pointCodes)}
+    points = np.zeros((len(mouthClosed), len(faceProcessor.pointCodes), 3), dtype=np.float32)
+    points[:, columns[faceProcessor.tipOfChin], 1] = 1.0
+    for upperLipPoint, lowerLipPoint in zip(faceProcessor.upperLipPoints, faceProcessor.lowerLipPoints):
+        points[:, columns[upperLipPoint], 1] = 0.5
+        points[:, columns[lowerLipPoint], 1] = np.where(mouthClosed, 0.505, 0.55)
+    return points
+
+@pytest.mark.parametrize("seed", range(20))
+def testChunkedAnalysisMatchesAWholePass(seed):
+    randomGenerator = np.random.default_rng(seed)
+    faceProcessor = VideoFaceProcessor(None)
+    faceProcessor.setFrameRate(30)
+    numRuns = int(randomGenerator.integers(1, 300))
+    mouthClosed = np.repeat(randomGenerator.random(numRuns) < 0.5, randomGenerator.integers(1, 12, numRuns)) #runs of open and shut frames, some long enough to be pauses
+    timestamps = np.arange(len(mouthClosed)) / 30
+    points = facePoints(faceProcessor, mouthClosed)
+    progressiveSync = ProgressiveSync(None)
+    landmarks = LandmarkStore(faceProcessor.pointCodes)
+    chunkFrames = int(randomGenerator.integers(1, 100))
+    for startFrame in range(0, len(mouthClosed), chunkFrames):
+        progressiveSync.analyseChunk(faceProcessor, landmarks, LandmarkStore.fromArrays(faceProcessor.pointCodes, timestamps[startFrame:startFrame + chunkFrames], points[startFrame:startFrame + chunkFrames]))
+    wholePass = LandmarkStore.fromArrays(faceProcessor.pointCodes, timestamps, points)
+    faceProcessor.analyseLipMovement(wholePass)
+    assert landmarks.speaking.tolist() == wholePass.speaking.tolist()
+    assert progressiveSync.videoSpeechStarts == findSpeechStartTimes(wholePass.timestamps, wholePass.speaking, progressiveSync.numFramesToCheck)
+
+def testAudioSpeechStartsAreFoundIncrementally():
+    randomGenerator = np.random.default_rng(0)
+    audioTimestamps = (np.arange(3000) * 0.03).tolist()
+    audioSpeaking = np.repeat(randomGenerator.random(300) < 0.5, 10).tolist()
+    progressiveSync = ProgressiveSync(None)
+    for numDecisions in range(0, 3001, 137):
+        progressiveSync.updateMatches(audioTimestamps[:numDecisions], audioSpeaking[:numDecisions], 0)
+    progressiveSync.updateMatches(audioTimestamps, audioSpeaking, None)
+    assert progressiveSync.audioSpeechStarts == findSpeechStartTimes(audioTimestamps, audioSpeaking, progressiveSync.numFramesToCheck)
@@ -0,0 +1,64 @@
+import os
+import numpy as np
+import pytest
+from resultCache import ResultCache
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResultCache(str(tmp_path / "cache"))
+
+@pytest.fixture
+def sourceFile(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(b"not really a video")
+    return str(path)
+
+def testSavedEntryIsLoaded(cache, sourceFile):
+    key = cache.key(sourceFile, "speech", {"level": 1})
+    cache.save(key, timestamps=np.arange(5, dtype=np.float64), speaking=np.array([True, False, True, True, False]))
+    arrays = cache.load(key, ("timestamps", "speaking"))
+    assert arrays["timestamps"].tolist() == [0, 1, 2, 3, 4]
+    assert arrays["speaking"].tolist() == [True, False, True, True, False]
+
+def testMissingEntryIsAMiss(cache, sourceFile):
+    assert cache.load(cache.key(sourceFile, "speech", {"level": 1})) is None
+
+def testChangedParametersOrContentsMiss(cache, sourceFile):
+    key = cache.key(sourceFile, "speech", {"level": 1})
+    cache.save(key, timestamps=np.zeros(3))
+    assert cache.load(cache.key(sourceFile, "speech", {"level": 2})) is None
+    with open(sourceFile, 'ab') as fileHandle:
+        fileHandle.write(b"more")
+    os.utime(sourceFile, ns=(0, 0)) #a new modification time, so that the file is hashed again
+    assert cache.key(sourceFile, "speech", {"level": 1}) != key
+
+@pytest.mark.parametrize("contents", [b"", b"garbage", b"PK\x03\x04truncated zip"])
+def testCorruptEntryIsAMissAndRemoved(cache, contents):
+    path = cache.entryPath("speech-corrupt")
+    with open(path, 'wb') as fileHandle:
+        fileHandle.write(contents)
+    assert cache.load("speech-corrupt") is None
+    assert not os.path.exists(path)
+
+def testTruncatedEntryIsAMiss(cache):
+    cache.save("speech-truncated", timestamps=np.arange(1000, dtype=np.float64))
+    path = cache.entryPath("speech-truncated")
+    with open(path, 'r+b') as fileHandle:
+        fileHandle.truncate(os.path.getsize(path) // 2)
+    assert cache.load("speech-truncated") is None
+
+def testEntryWithoutRequiredArraysIsAMiss(cache):
+    cache.save("speech-old", timestamps=np.zeros(3))
+    assert cache.load("speech-old", ("timestamps", "speaking")) is None
+
+def testLeastRecentlyUsedEntriesAreEvicted(cache):
+    cache.save("entry-first", values=np.zeros(1000))
+    entryBytes = os.path.getsize(cache.entryPath("entry-first"))
+    cache.maxBytes = 2 * entryBytes
+    cache.save("entry-second", values=np.zeros(1000))
+    os.utime(cache.entryPath("entry-first"), (1, 1)); os.utime(cache.entryPath("entry-second"), (2, 2))
+    assert cache.load("entry-first") is not None #now the most recently used
+    cache.save("entry-third", values=np.zeros(1000))
+    assert os.path.exists(cache.entryPath("entry-first"))
+    assert not os.path.exists(cache.entryPath("entry-second"))
+    assert os.path.exists(cache.entryPath("entry-third"))
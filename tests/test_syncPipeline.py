@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("cv2")
+pytest.importorskip("mediapipe")
+pytest.importorskip("webrtcvad")
+from faceDetector import LandmarkStore, VideoFaceProcessor
+from syncPipeline import SyncPipeline
+from voiceActivityDetection import SpeechStore
+
+def testNoFaceGivesNoOffsetInsteadOfFailing():
+    pipeline = SyncPipeline("clip.mp4")
+    pipeline.faceProcessor = VideoFaceProcessor(None) #as after a video with no detectable face, or audio guided mode with no speech starts to search around
+    pipeline.audioMarkers = SpeechStore.fromArrays(np.arange(100) * 0.03, np.arange(100) % 20 < 10)
+    assert len(pipeline.faceProcessor.getDetectedSilences()) == 0
+    assert pipeline.estimateOffset() == (0.0, 0.0)
+    assert pipeline.chosenFilterLevel == pipeline.nonSpeechFilterLevel
+
+def testAudioGuidedEstimateMatchesTheFullPass(monkeypatch):
+    #---audio guided mode only landmarks the video within maxOffset + videoContextSeconds of each audio speech start, which should be all the estimate needs
+    from benchmark import SyntheticFixture
+    fixture = SyntheticFixture(120, seed=3, injectedOffset=0.4)
+    fixture.speechSegments = [(6 + 16 * i, 8 + 16 * i + i % 3) for i in range(7)] #sparse speech, so that most of the video is outside the searched windows
+    audioTimestamps = np.arange(int(fixture.durationSeconds / 0.03)) * 0.03
+    audioMarkers = SpeechStore.fromArrays(audioTimestamps, fixture.isSpeech(audioTimestamps))
+    allLandmarks = fixture.getLandmarks(VideoFaceProcessor(None))
+    def readVideoProperties(faceProcessor):
+        faceProcessor.setFrameRate(fixture.fps)
+        return len(allLandmarks)
+    def processFrameRanges(faceProcessor, frameRanges):#the landmarks a face mesh would give for just these frames
+        return [LandmarkStore.fromArrays(faceProcessor.pointCodes, allLandmarks.timestamps[startFrame:endFrame], allLandmarks.points[startFrame:endFrame]) for startFrame, endFrame in frameRanges]
+    monkeypatch.setattr(VideoFaceProcessor, "readVideoProperties", readVideoProperties)
+    monkeypatch.setattr(VideoFaceProcessor, "processFrameRanges", processFrameRanges)
+
+    fullPass = SyncPipeline("clip.mp4")
+    fullPass.audioMarkers = audioMarkers
+    fullPass.faceProcessor = VideoFaceProcessor(None)
+    fullPass.faceProcessor.setFrameRate(fixture.fps)
+    fullPass.faceProcessor.faces[fullPass.faceProcessor.hardCodedFaceID] = processFrameRanges(fullPass.faceProcessor, [(0, None)])[0]
+    fullPass.faceProcessor.calculateLipMovement()
+    fullOffset, fullConfidence = fullPass.estimateOffset()
+
+    audioGuided = SyncPipeline("clip.mp4")
+    monkeypatch.setattr(audioGuided, "analyseAudio", lambda: audioMarkers)
+    audioMarkers, videoMarkers = audioGuided.runAudioGuided()
+    assert 0 < len(videoMarkers) < len(allLandmarks) / 2
+    guidedOffset, guidedConfidence = audioGuided.estimateOffset()
+    assert fullOffset == pytest.approx(fixture.injectedOffset, abs=0.05)
+    assert guidedOffset == pytest.approx(fullOffset, abs=0.01)
+    assert guidedConfidence > 0
@@ -0,0 +1,65 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+import pytest
+
+pytest.importorskip("cv2")
+pytest.importorskip("mediapipe")
+import syncService
+from syncService import SyncService
+
+class StandInFaceMesh:
+    def __init__(self):
+        self.closed = False
+    def reset(self):
+        pass
+    def close(self):
+        self.closed = True
+
+def testFaceMeshesAreBuiltBeforeListening(monkeypatch):
+    builtFaceMeshes = []
+    def openFaceMesh(faceProcessor):
+        builtFaceMeshes.append(StandInFaceMesh())
+        return builtFaceMeshes[-1]
+    monkeypatch.setattr(syncService.VideoFaceProcessor, "openFaceMesh", openFaceMesh)
+    service = SyncService(port=0, numWorkers=3)
+    serving = threading.Thread(target=service.serve)
+    serving.start()
+    try:
+        while service.server is None:
+            serving.join(0.01)
+        assert len(builtFaceMeshes) == 3 and service.faceMeshes.qsize() == 3
+    finally:
+        service.shutdown()
+        serving.join()
+    assert all(faceMesh.closed for faceMesh in builtFaceMeshes)
+
+def testFailingToBuildAFaceMeshStopsTheServiceBeforeListening(monkeypatch):
+    def failToOpen(faceProcessor):
+        raise RuntimeError("no graph")
+    monkeypatch.setattr(syncService.VideoFaceProcessor, "openFaceMesh", failToOpen)
+    service = SyncService(port=0)
+    with pytest.raises(RuntimeError, match="no graph"):
+        service.serve()
+    assert service.server is None
+
+def testJobsPostedWhileShuttingDownAreRefused(monkeypatch, tmp_path):
+    monkeypatch.setattr(syncService.VideoFaceProcessor, "openFaceMesh", lambda faceProcessor: StandInFaceMesh())
+    source = tmp_path / "clip.mp4"
+    source.write_bytes(b"")
+    service = SyncService(port=0, numWorkers=1)
+    serving = threading.Thread(target=service.serve)
+    serving.start()
+    try:
+        while service.server is None:
+            serving.join(0.01)
+        service.executor.shutdown() #as when the service is stopping
+        request = urllib.request.Request(f"http://127.0.0.1:{service.server.server_address[1]}/jobs", data=json.dumps({"source": str(source)}).encode(), method="POST")
+        with pytest.raises(urllib.error.HTTPError) as refusal:
+            urllib.request.urlopen(request, timeout=10)
+        assert refusal.value.code == 503
+        assert service.jobRecords() == [] #no job is left queued forever
+    finally:
+        service.shutdown()
+        serving.join()
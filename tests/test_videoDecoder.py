@@ -0,0 +1,18 @@
+import shutil
+import pytest
+
+pytest.importorskip("cv2")
+from videoDecoder import FfmpegDecoder
+
+@pytest.mark.parametrize("rate, fps", [("30/1", 30.0), ("30000/1001", 30000 / 1001), ("25", 25.0), ("0/0", 0.0), ("0/1", 0.0), (None, 0.0)])
+def testFrameRateParsing(rate, fps):
+    assert FfmpegDecoder("video.mp4").frameRate(rate) == pytest.approx(fps)
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def testFailedDecodeIsReported(tmp_path):
+    decoder = FfmpegDecoder(str(tmp_path / "missing.mp4"))
+    decoder.fps = 30; decoder.width = 64; decoder.height = 64 #skips ffprobe
+    decoder.open(0)
+    assert not decoder.read()[0]
+    with pytest.raises(RuntimeError, match="missing.mp4"):
+        decoder.release()
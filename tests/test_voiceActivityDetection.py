@@ -0,0 +1,80 @@
+import collections
+import os
+import random
+import shutil
+import subprocess
+import pytest
+
+pytest.importorskip("webrtcvad")
+from resultCache import ResultCache
+from voiceActivityDetection import AudioProcessor, Frame, VoiceActivityDetector
+
+needsFfmpeg = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+
+def referenceVadCollector(sample_rate, frame_duration_ms, padding_duration_ms, vad, frames):
+    #---the original loop from the webrtcvad example, which recounts the ring buffer on every frame
+    ring_buffer = collections.deque(maxlen=int(padding_duration_ms / frame_duration_ms))
+    triggered = False
+    voiced_frames = []
+    for frame in frames:
+        is_speech = vad.is_speech(frame.bytes, sample_rate)
+        if not triggered:
+            ring_buffer.append((frame, is_speech))
+            if len([f for f, speech in ring_buffer if speech]) > 0.9 * ring_buffer.maxlen:
+                triggered = True
+                voiced_frames.extend(f for f, s in ring_buffer)
+                ring_buffer.clear()
+        else:
+            voiced_frames.append(frame)
+            ring_buffer.append((frame, is_speech))
+            if len([f for f, speech in ring_buffer if not speech]) > 0.9 * ring_buffer.maxlen:
+                triggered = False
+                yield b''.join([f.bytes for f in voiced_frames])
+                ring_buffer.clear()
+                voiced_frames = []
+    if voiced_frames:
+        yield b''.join([f.bytes for f in voiced_frames])
+
+class ScriptedVad:
+    #---a stand-in for webrtcvad.Vad that gives pre-set decisions, one per call
+    def __init__(self, decisions):
+        self.decisions = iter(decisions)
+    def is_speech(self, frameBytes, sample_rate):
+        return next(self.decisions)
+
+@pytest.mark.parametrize("paddingDurationMs", [0, 30, 90, 300, 600])
+def testVadCollectorMatchesReferenceLoop(paddingDurationMs):
+    randomGenerator = random.Random(paddingDurationMs)
+    for trial in range(200):
+        speechProbability = randomGenerator.random()
+        decisions = [randomGenerator.random() < speechProbability for _ in range(randomGenerator.randint(0, 200))]
+        frames = [Frame(frameIndex.to_bytes(2, "little") * 2, frameIndex * 0.03, 0.03) for frameIndex in range(len(decisions))] #distinct bytes per frame, so the yielded audio shows which frames it came from
+        expected = list(referenceVadCollector(16000, 30, paddingDurationMs, ScriptedVad(decisions), frames))
+        audioProcessor = AudioProcessor()
+        assert list(audioProcessor.vad_collector(16000, 30, paddingDurationMs, ScriptedVad(decisions), frames)) == expected
+        assert audioProcessor.speechDetected.speaking.tolist() == decisions
+
+def testMultiLevelPassMatchesSingleLevelRuns():
+    from benchmark import SyntheticFixture
+    fixture = SyntheticFixture(30, seed=1)
+    audioProcessor = AudioProcessor()
+    def detect(levels):
+        vad = VoiceActivityDetector()
+        vad.startRun("synthetic.wav", levels[0], levels[1:])
+        vad.detectSpeech(audioProcessor.frame_generator(vad.frameDurationMs, fixture.pcm, fixture.sampleRate), fixture.sampleRate, levels)
+        return vad
+    together = detect([1, 0, 2, 3])
+    for level in range(4):
+        alone = detect([level])
+        assert together.getSpeechDetectedSections(level).timestamps.tolist() == alone.getSpeechDetectedSections().timestamps.tolist()
+        assert together.getSpeechDetectedSections(level).speaking.tolist() == alone.getSpeechDetectedSections().speaking.tolist()
+        assert together.getSegments(level) == alone.getSegments()
+
+@needsFfmpeg
+def testStreamWithoutAudioFailsAndIsNotCached(tmp_path):
+    videoFile = str(tmp_path / "silentFilm.mkv")
+    subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "lavfi", "-i", "testsrc=duration=1:size=64x64:rate=10", videoFile], check=True)
+    cache = ResultCache(str(tmp_path / "cache"))
+    with pytest.raises(RuntimeError, match="silentFilm.mkv"):
+        VoiceActivityDetector(cache).runOnStream(videoFile, 1)
+    assert not [fileName for fileName in os.listdir(cache.cacheDirectory) if fileName.endswith(cache.fileExtension)]
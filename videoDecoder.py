@@ -0,0 +1,171 @@
+import json
+import math
+import queue
+import re
+from collections import deque
+import shlex
+import subprocess
+import threading
+import cv2
+import numpy as np
+from instrumentation import instruments
+
+class Const:
+    MILLISECONDS_IN_ONE_SECOND = 1000
+
+class OpenCvDecoder:
+    """Decodes frames through cv2.VideoCapture at the video's own resolution and frame rate.
+    read() returns (frameExists, image, timestamp in seconds, frame number). The image is BGR, as OpenCV decodes it, so that the caller converts it only to whatever it needs (see channelOrder).
+    """
+    def __init__(self, videoSource) -> None:
+        self.videoSource = videoSource
+        self.channelOrder = "BGR" #of the images read() returns
+        self.videoHandle = None
+        self.frameNumber = 0
+
+    def readProperties(self):#returns (fps, numFrames)
+        videoHandle = cv2.VideoCapture(self.videoSource)
+        fps = videoHandle.get(cv2.CAP_PROP_FPS)
+        numFrames = int(videoHandle.get(cv2.CAP_PROP_FRAME_COUNT))
+        videoHandle.release()
+        return fps, numFrames
+
+    def open(self, firstFrame, endFrame=None):#endFrame is left to the caller, which stops reading there
+        self.videoHandle = cv2.VideoCapture(self.videoSource)
+        if firstFrame > 0:
+            self.videoHandle.set(cv2.CAP_PROP_POS_FRAMES, firstFrame)
+        self.frameNumber = firstFrame
+
+    def read(self):
+        if not self.videoHandle.isOpened():
+            return False, None, None, self.frameNumber
+        with instruments.timer("decode"):
+            frameExists, theImage = self.videoHandle.read()
+        if not frameExists:
+            return False, None, None, self.frameNumber
+        timestamp = self.videoHandle.get(cv2.CAP_PROP_POS_MSEC) / Const.MILLISECONDS_IN_ONE_SECOND
+        frameNumber = self.frameNumber
+        self.frameNumber = self.frameNumber + 1
+        return True, theImage, timestamp, frameNumber
+
+    def release(self):
+        if self.videoHandle is not None:
+            self.videoHandle.release()
+            self.videoHandle = None
+
+class FfmpegDecoder:
+    """Decodes frames with ffmpeg, which scales them down to analysisWidth and resamples them to analysisFps before piping them out as raw RGB, so no full size frames reach Python.
+    Frame numbers count frames at the analysis frame rate. Timestamps are the presentation timestamps ffmpeg reports for each frame (through the showinfo filter), less the file's start time, so that they start from 0 like the audio's.
+    The image read() returns is a view on a buffer that the next read() overwrites.
+    """
+    def __init__(self, videoSource, analysisFps=None, analysisWidth=None) -> None:
+        self.videoSource = videoSource
+        self.analysisFps = analysisFps #None keeps the video's frame rate. Never more than the video's frame rate
+        self.analysisWidth = analysisWidth #None keeps the video's width. Never more than the video's width
+        self.channelOrder = "RGB" #of the images read() returns, since ffmpeg converts to whichever is asked for at no extra cost
+        self.fps = None
+        self.startTime = 0.0 #seconds. The presentation timestamp of the start of the file
+        self.width = None
+        self.height = None
+        self.process = None
+        self.frameStream = None
+        self.frameBuffer = None
+        self.timestamps = None #queue of (timestamp, width, height) per frame
+        self.stderrThread = None
+        self.exitTimeout = 10 #seconds ffmpeg is given to exit once its output has ended
+        self.reachedEnd = False #read() saw the end of the output, so ffmpeg wasn't stopped early
+        self.logLines = deque(maxlen=20) #the latest lines ffmpeg logged other than the per frame ones, for the error message if it fails
+        self.ptsPattern = re.compile(rb"pts_time:\s*(-?[0-9.]+).*? s:(\d+)x(\d+)")
+
+    def readProperties(self):#returns (fps, numFrames), both at the analysis frame rate
+        command = f"ffprobe -v error -select_streams v:0 -show_entries stream=width,height,avg_frame_rate,r_frame_rate,duration:format=duration,start_time -of json {shlex.quote(self.videoSource)}"
+        probe = json.loads(subprocess.run(shlex.split(command), capture_output=True, check=True).stdout)
+        if not probe.get("streams"):
+            raise ValueError(f"{self.videoSource} has no video stream")
+        stream = probe["streams"][0]
+        sourceFps = self.frameRate(stream.get("avg_frame_rate")) or self.frameRate(stream.get("r_frame_rate")) #the average is 0/0 in some containers, e.g. while a file is still being written
+        if not sourceFps:
+            raise ValueError(f"ffprobe reports no frame rate for {self.videoSource}")
+        durationSeconds = float(stream.get("duration") or probe.get("format", {}).get("duration") or 0)
+        self.startTime = float(probe.get("format", {}).get("start_time") or 0)
+        self.fps = min(self.analysisFps, sourceFps) if self.analysisFps else sourceFps
+        self.width = int(stream["width"]); self.height = int(stream["height"])
+        if self.analysisWidth and self.analysisWidth < self.width:
+            self.height = max(2, 2 * round(self.height * self.analysisWidth / self.width / 2)) #yuv formats need even dimensions
+            self.width = max(2, 2 * (self.analysisWidth // 2))
+        return self.fps, int(math.ceil(durationSeconds * self.fps))
+
+    def frameRate(self, rate):#an ffprobe rate such as "30000/1001", or 0.0 if it is missing or 0/0
+        numerator, _, denominator = (rate or "0/0").partition("/")
+        denominator = float(denominator or 1)
+        return float(numerator) / denominator if denominator else 0.0
+
+    def open(self, firstFrame, endFrame=None):
+        if self.fps is None:
+            self.readProperties()
+        filters = f"setpts=PTS-{self.startTime:.6f}/TB," if self.startTime else "" #timestamps from the start of the file, before the frame rate filter lays its frame grid on them
+        filters += f"fps={self.fps:.6f}," if self.analysisFps else ""
+        filters += f"scale={self.width}:{self.height},showinfo"
+        seek = f"-ss {firstFrame / self.fps:.6f} " if firstFrame > 0 else ""
+        duration = f"-t {(endFrame - firstFrame + 1) / self.fps:.6f} " if endFrame is not None else "" #a frame to spare, since the caller stops at endFrame anyway
+        #----copyts keeps the timestamps of the original file after seeking, so that frames of every range share one time base. The duration is given as an input option, since as an output option it would be measured on those timestamps
+        command = f"ffmpeg -hide_banner -nostats -loglevel info {seek}{duration}-copyts -i {shlex.quote(self.videoSource)} -an -vf {shlex.quote(filters)} -f rawvideo -pix_fmt rgb24 pipe:1"
+        instruments.count("ffmpegProcesses")
+        self.process = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0)
+        self.startReading(self.process.stdout, self.process.stderr)
+
+    def startReading(self, frameStream, logStream):#frames are read from frameStream, and their timestamps and sizes from the showinfo lines on logStream
+        self.frameStream = frameStream
+        self.frameBuffer = bytearray()
+        self.timestamps = queue.Queue()
+        self.reachedEnd = False
+        self.logLines.clear()
+        self.stderrThread = threading.Thread(target=self.readTimestamps, args=(logStream,), daemon=True)
+        self.stderrThread.start()
+
+    def readTimestamps(self, logStream):#showinfo logs one line per frame, before the frame is written out
+        for line in logStream:
+            match = self.ptsPattern.search(line)
+            if match:
+                self.timestamps.put((float(match.group(1)), int(match.group(2)), int(match.group(3))))
+            elif line.strip():
+                self.logLines.append(line.decode(errors="replace").rstrip())
+        self.timestamps.put(None) #end of stream
+
+    def read(self):
+        with instruments.timer("decode"):
+            frameInfo = self.timestamps.get()
+            if frameInfo is None:
+                self.reachedEnd = True
+                return False, None, None, None
+            timestamp, width, height = frameInfo
+            if len(self.frameBuffer) != width * height * 3:#the first frame, or the size of a live stream changed
+                self.frameBuffer = bytearray(width * height * 3)
+            view = memoryview(self.frameBuffer)
+            bytesRead = 0
+            while bytesRead < len(self.frameBuffer):#a pipe can return less than a whole frame at a time
+                numBytes = self.frameStream.readinto(view[bytesRead:])
+                if not numBytes:
+                    self.reachedEnd = True
+                    return False, None, None, None
+                bytesRead = bytesRead + numBytes
+        theImage = np.frombuffer(self.frameBuffer, dtype=np.uint8).reshape(height, width, 3)
+        return True, theImage, timestamp, int(round(timestamp * self.fps))
+
+    def release(self):#raises RuntimeError if ffmpeg failed, unless it was stopped before the end of its output
+        if self.process is None:
+            return
+        stoppedEarly = not self.reachedEnd
+        if not stoppedEarly:#its output has ended, so it is exiting, but may not have exited yet
+            try:
+                self.process.wait(timeout=self.exitTimeout)
+            except subprocess.TimeoutExpired:
+                stoppedEarly = True
+        self.process.stdout.close()
+        if stoppedEarly:
+            self.process.kill()
+        returnCode = self.process.wait()
+        self.stderrThread.join()
+        self.process = None
+        if not stoppedEarly and returnCode != 0:
+            raise RuntimeError(f"ffmpeg failed decoding {self.videoSource} (exit code {returnCode}): " + " | ".join(self.logLines))
@@ -1,15 +1,67 @@
 #Attribution: https://github.com/wiseman/py-webrtcvad
 import collections
 import contextlib
+import os
+import subprocess
 import sys
+import tempfile
 import wave
+import numpy as np
 import webrtcvad
+from instrumentation import instruments, Verbosity
 
 class Speech:
     def __init__(self, timestamp, speaking) -> None:
         self.timestamp = timestamp
         self.speaking = speaking
 
+class SpeechStore:
+    """Columnar store of speech decisions: a timestamps array and a speaking array, about 9 bytes per audio frame instead of a Speech object each.
+    Iterating or indexing it gives Speech objects, for code that still works with those.
+    """
+    def __init__(self, capacity=1024) -> None:
+        self.numFrames = 0
+        self.allTimestamps = np.zeros(capacity, dtype=np.float64) #grows by doubling as decisions are appended
+        self.allSpeaking = np.zeros(capacity, dtype=bool)
+
+    @classmethod
+    def fromArrays(cls, timestamps, speaking):
+        speechStore = cls(capacity=max(1, len(timestamps)))
+        speechStore.numFrames = len(timestamps)
+        speechStore.allTimestamps[:speechStore.numFrames] = timestamps
+        speechStore.allSpeaking[:speechStore.numFrames] = speaking
+        return speechStore
+
+    @property
+    def timestamps(self):
+        return self.allTimestamps[:self.numFrames]
+
+    @property
+    def speaking(self):
+        return self.allSpeaking[:self.numFrames]
+
+    def append(self, timestamp, speaking):
+        if self.numFrames == len(self.allTimestamps):
+            self.allTimestamps = np.concatenate((self.allTimestamps, np.zeros(max(1, self.numFrames), dtype=np.float64)))
+            self.allSpeaking = np.concatenate((self.allSpeaking, np.zeros(max(1, self.numFrames), dtype=bool)))
+        self.allTimestamps[self.numFrames] = timestamp
+        self.allSpeaking[self.numFrames] = speaking
+        self.numFrames = self.numFrames + 1
+
+    def __len__(self):
+        return self.numFrames
+
+    def __getitem__(self, frameIndex):
+        if frameIndex < 0:
+            frameIndex = frameIndex + self.numFrames
+        if not 0 <= frameIndex < self.numFrames:
+            raise IndexError("frame index out of range")
+        return Speech(float(self.allTimestamps[frameIndex]), bool(self.allSpeaking[frameIndex]))
+
+    def __iter__(self):
+        for frameIndex in range(self.numFrames):
+            yield self[frameIndex]
+
 class Frame(object):
     """Represents a "frame" of audio data."""
     def __init__(self, bytes, timestamp, duration):
@@ -19,7 +71,7 @@ class Frame(object):
 
 class AudioProcessor:        
     def __init__(self) -> None:
-        self.speechDetected = collections.deque()
+        self.speechDetected = SpeechStore()
 
     def read_wave(self, path):
         """Reads a .wav file.
@@ -65,6 +117,75 @@ class AudioProcessor:
             offset += n
 
 
+    def open_pcm_stream(self, path, sample_rate, start_seconds=0, duration_seconds=None):
+        """Starts ffmpeg decoding the audio of any media file to raw 16-bit
+        mono PCM at sample_rate on its stdout.
+
+        Optionally only decodes duration_seconds of audio from start_seconds
+        onwards.
+
+        Returns the subprocess.Popen handle. Read the PCM from its stdout.
+        ffmpeg's error output goes to a temporary file, process.error_log,
+        which check_pcm_stream reports from.
+        """
+        command = ['ffmpeg', '-hide_banner', '-loglevel', 'error']
+        if start_seconds > 0:
+            command += ['-ss', str(start_seconds)]
+        if duration_seconds is not None:
+            command += ['-t', str(duration_seconds)]
+        command += ['-i', path, '-vn', '-ac', '1', '-ar', str(sample_rate), '-f', 's16le', '-']
+        error_log = tempfile.TemporaryFile() # a file rather than a pipe, so that a lot of error output can't block ffmpeg
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=error_log)
+        process.error_log = error_log
+        return process
+
+    def check_pcm_stream(self, process, path):
+        """Raises RuntimeError with ffmpeg's error output if a stream from
+        open_pcm_stream failed, e.g. because the file has no audio or is
+        corrupt partway through. Call it after reading the whole stream
+        and waiting for ffmpeg to exit.
+        """
+        process.error_log.seek(0)
+        errors = process.error_log.read().decode(errors='replace').strip()
+        process.error_log.close()
+        if process.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed decoding the audio of {path} (exit code {process.returncode}): {errors}")
+
+
+    def stream_frame_generator(self, frame_duration_ms, stream, sample_rate, frames_per_block=1000, start_timestamp=0.0):
+        """Generates audio frames from a stream of PCM audio data.
+
+        Takes the desired frame duration in milliseconds, a binary stream
+        (such as an ffmpeg stdout pipe) and the sample rate.
+
+        The stream is read in blocks of frames_per_block frames, and each
+        yielded Frame holds a memoryview into its block instead of a copy,
+        so memory use does not grow with the length of the input. A partial
+        frame at the end of the stream is dropped. Timestamps count from
+        start_timestamp, for streams that start part way into the media.
+
+        Yields Frames of the requested duration.
+        """
+        n = int(sample_rate * (frame_duration_ms / 1000.0) * 2)
+        timestamp = start_timestamp
+        duration = (float(n) / sample_rate) / 2.0
+        while True:
+            # A fresh block each time, since frames still held by the caller
+            # (e.g. in the vad_collector ring buffer) point into the old one.
+            block = memoryview(bytearray(n * frames_per_block))
+            filled = 0
+            while filled < len(block):
+                count = stream.readinto(block[filled:])
+                if not count:
+                    break
+                filled += count
+            for offset in range(0, filled - n + 1, n):
+                yield Frame(block[offset:offset + n], timestamp, duration)
+                timestamp += duration
+            if filled < len(block):
+                break
+
+
     def vad_collector(self, sample_rate, frame_duration_ms, padding_duration_ms, vad, frames):
         """Filters out non-voiced audio frames.
 
@@ -91,79 +212,193 @@ class AudioProcessor:
 
         Returns: A generator that yields PCM audio data.
         """
-        num_padding_frames = int(padding_duration_ms / frame_duration_ms)
-        # We use a deque for our sliding window/ring buffer.
-        ring_buffer = collections.deque(maxlen=num_padding_frames)
-        # We have two states: TRIGGERED and NOTTRIGGERED. We start in the
-        # NOTTRIGGERED state.
-        triggered = False
-
-        voiced_frames = []
+        # The triggering itself is SpeechSegmenter's. Only the frames that
+        # a segment may still start from (the ones in its ring buffer), or
+        # the frames of the open segment, are held on to for their audio.
+        segmenter = SpeechSegmenter(frame_duration_ms, padding_duration_ms)
+        pending_frames = []
         for frame in frames:
             is_speech = vad.is_speech(frame.bytes, sample_rate)
-            #print(f"{is_speech} Frame start time (seconds): {frame.timestamp}, {len(self.speechDetected)}")        
-            speechObject = Speech(frame.timestamp, is_speech)
-            self.speechDetected.append(speechObject)
-            #sys.stdout.write('1' if is_speech else '0')
-            if not triggered:
-                ring_buffer.append((frame, is_speech))
-                num_voiced = len([f for f, speech in ring_buffer if speech])
-                # If we're NOTTRIGGERED and more than 90% of the frames in
-                # the ring buffer are voiced frames, then enter the
-                # TRIGGERED state.
-                if num_voiced > 0.9 * ring_buffer.maxlen:
-                    triggered = True
-                    #sys.stdout.write('+(%s)' % (ring_buffer[0][0].timestamp,))
-                    # We want to yield all the audio we see from now until
-                    # we are NOTTRIGGERED, but we have to start with the
-                    # audio that's already in the ring buffer.
-                    for f, s in ring_buffer:
-                        voiced_frames.append(f)
-                    ring_buffer.clear()
-            else:
-                # We're in the TRIGGERED state, so collect the audio data
-                # and add it to the ring buffer.
-                voiced_frames.append(frame)
-                ring_buffer.append((frame, is_speech))
-                num_unvoiced = len([f for f, speech in ring_buffer if not speech])
-                # If more than 90% of the frames in the ring buffer are
-                # unvoiced, then enter NOTTRIGGERED and yield whatever
-                # audio we've collected.
-                if num_unvoiced > 0.9 * ring_buffer.maxlen:
-                    #sys.stdout.write('-(%s)' % (frame.timestamp + frame.duration))
-                    triggered = False
-                    yield b''.join([f.bytes for f in voiced_frames])
-                    ring_buffer.clear()
-                    voiced_frames = []
-        #if triggered:
-        #    sys.stdout.write('-(%s)' % (frame.timestamp + frame.duration))
-        #sys.stdout.write('\n')
+            instruments.count("vadCalls")
+            self.speechDetected.append(frame.timestamp, is_speech)
+            pending_frames.append(frame)
+            num_segments = len(segmenter.segments)
+            segmenter.push(frame.timestamp, frame.duration, is_speech)
+            if len(segmenter.segments) > num_segments:
+                yield self.segment_audio(pending_frames, segmenter.segments[-1])
+                pending_frames = []
+            elif not segmenter.triggered and len(pending_frames) > segmenter.ringBuffer.maxlen:
+                del pending_frames[:len(pending_frames) - segmenter.ringBuffer.maxlen]
         # If we have any leftover voiced audio when we run out of input, yield it.
-        if voiced_frames:
-            yield b''.join([f.bytes for f in voiced_frames])
-    
+        num_segments = len(segmenter.segments)
+        segmenter.finish()
+        if len(segmenter.segments) > num_segments:
+            yield self.segment_audio(pending_frames, segmenter.segments[-1])
+
+    def segment_audio(self, frames, segment):
+        """Joins the audio of the frames that fall within a (start, end) segment."""
+        return b''.join([f.bytes for f in frames if f.timestamp >= segment[0]])
+
+class SpeechSegmenter:
+    """The triggering state machine behind vad_collector and VoiceActivityDetector. It takes one speech decision at a time and records where each voiced segment starts and ends instead of collecting its audio,
+    so it needs no audio buffers, and it keeps a running count of the voiced frames in its ring buffer so each decision costs O(1)."""
+    def __init__(self, frameDurationMs, paddingDurationMs) -> None:
+        self.ringBuffer = collections.deque(maxlen=int(paddingDurationMs / frameDurationMs)) #(timestamp, isSpeech) of the latest frames
+        self.numVoiced = 0 #voiced frames in the ring buffer
+        self.triggered = False
+        self.segmentStart = None
+        self.lastFrameEnd = None
+        self.segments = [] #[(startSeconds, endSeconds)] of voiced audio
+
+    def push(self, timestamp, duration, isSpeech):
+        self.lastFrameEnd = timestamp + duration
+        if self.ringBuffer.maxlen == 0:
+            return
+        if len(self.ringBuffer) == self.ringBuffer.maxlen and self.ringBuffer[0][1]:#the oldest frame is about to drop out
+            self.numVoiced = self.numVoiced - 1
+        self.ringBuffer.append((timestamp, isSpeech))
+        if isSpeech:
+            self.numVoiced = self.numVoiced + 1
+        if not self.triggered:
+            if self.numVoiced > 0.9 * self.ringBuffer.maxlen:#the segment includes the frames already in the ring buffer
+                self.triggered = True
+                self.segmentStart = self.ringBuffer[0][0]
+                self.ringBuffer.clear(); self.numVoiced = 0
+        elif len(self.ringBuffer) - self.numVoiced > 0.9 * self.ringBuffer.maxlen:
+            self.triggered = False
+            self.segments.append((self.segmentStart, self.lastFrameEnd))
+            self.ringBuffer.clear(); self.numVoiced = 0
+
+    def finish(self):#closes a segment that is still open when the audio ends
+        if self.triggered:
+            self.segments.append((self.segmentStart, self.lastFrameEnd))
+            self.triggered = False
+
 class VoiceActivityDetector:
-    def __init__(self) -> None:
+    """Runs webrtcvad over the audio, evaluating any number of aggressiveness levels in the same pass over the frames.
+    The level passed to run()/runOnStream() is the primary one, returned by getSpeechDetectedSections() with no level given; otherLevels are evaluated alongside it.
+    Voiced segments are only recorded as time ranges. Writing them out as chunk-NN.wav files is opt-in (exportSegments, or a call to splitAudioIntoSegments), and decodes just those ranges again.
+    """
+    def __init__(self, cache=None) -> None:
         self.audioProcessor = AudioProcessor()
-        self.segments = None
-
-    def run(self, audioFile, levelTofilterNonSpeech):#levelTofilterNonSpeech ranges from 0 to 3, where 3 is most aggressive about filtering out non-speech
-        print(f"Processing {audioFile}")
-        audio, sample_rate = self.audioProcessor.read_wave(audioFile)
-        vad = webrtcvad.Vad(levelTofilterNonSpeech)
-        frames = self.audioProcessor.frame_generator(30, audio, sample_rate)
-        frames = list(frames)    
-        self.segments = self.audioProcessor.vad_collector(sample_rate, 30, 300, vad, frames)  
-        #---write so that the generator function works and produces the speech detection
-        for i, segment in enumerate(self.segments):
-            path = 'chunk-%002d.wav' % (i,)
-            #print(' Writing %s' % (path,))
-            self.audioProcessor.write_wave(path, segment, sample_rate)
-
-    def getSpeechDetectedSections(self):
-        return self.audioProcessor.speechDetected
-
-    def splitAudioIntoSegments(self):
-        for i, segment in enumerate(self.segments):
-            path = 'chunk-%002d.wav' % (i,)
-            print(' Writing %s' % (path,))        
+        self.frameDurationMs = 30
+        self.paddingDurationMs = 300
+        self.segmentDirectory = "." #where the voiced segments are written as chunk-NN.wav files
+        self.exportSegments = False #True writes the voiced segments of the primary level to segmentDirectory after detection
+        self.cache = cache #a ResultCache that speech decisions are loaded from instead of running the VAD, if they were cached before with the same parameters
+        self.primaryLevel = None
+        self.speechByLevel = {} #{level: SpeechStore}
+        self.segmentsByLevel = {} #{level: [(startSeconds, endSeconds)]}
+        self.sourceFile = None #what the segments are cut from when exported
+        self.sampleRate = None
+
+    def run(self, audioFile, levelTofilterNonSpeech, otherLevels=()):#levelTofilterNonSpeech ranges from 0 to 3, where 3 is most aggressive about filtering out non-speech
+        instruments.log(Verbosity.NORMAL, f"Processing {audioFile}")
+        levels = self.startRun(audioFile, levelTofilterNonSpeech, otherLevels)
+        cacheKeys = {level: self.speechCacheKey(audioFile, {"level": level, "frameDurationMs": self.frameDurationMs}) for level in levels}
+        if self.loadCachedSpeech(cacheKeys):
+            with contextlib.closing(wave.open(audioFile, 'rb')) as wf:
+                self.sampleRate = wf.getframerate()
+        else:
+            audio, self.sampleRate = self.audioProcessor.read_wave(audioFile)
+            frames = self.audioProcessor.frame_generator(self.frameDurationMs, audio, self.sampleRate)
+            self.detectSpeech(frames, self.sampleRate, levels)
+            self.saveCachedSpeech(cacheKeys)
+        self.finishRun()
+
+    def runOnStream(self, mediaFile, levelTofilterNonSpeech, sample_rate=16000, startSeconds=0, durationSeconds=None, otherLevels=()):#decodes the audio of mediaFile (or only durationSeconds of it from startSeconds) through an ffmpeg pipe, so no WAV file is written and the audio is never fully held in memory
+        instruments.log(Verbosity.NORMAL, f"Streaming audio of {mediaFile}")
+        levels = self.startRun(mediaFile, levelTofilterNonSpeech, otherLevels)
+        self.sampleRate = sample_rate
+        cacheKeys = {}
+        for level in levels:
+            parameters = {"level": level, "frameDurationMs": self.frameDurationMs, "sampleRate": sample_rate}
+            if startSeconds > 0 or durationSeconds is not None:
+                parameters.update(startSeconds=startSeconds, durationSeconds=durationSeconds)
+            cacheKeys[level] = self.speechCacheKey(mediaFile, parameters)
+        if not self.loadCachedSpeech(cacheKeys):
+            with instruments.timer("ffmpeg"):#decoding overlaps with the VAD, so this is the lifetime of the decoding process
+                process = self.audioProcessor.open_pcm_stream(mediaFile, sample_rate, startSeconds, durationSeconds)
+                try:
+                    frames = self.audioProcessor.stream_frame_generator(self.frameDurationMs, process.stdout, sample_rate, start_timestamp=startSeconds)
+                    self.detectSpeech(frames, sample_rate, levels)
+                finally:
+                    process.stdout.close()
+                    process.wait()
+            self.audioProcessor.check_pcm_stream(process, mediaFile) #the whole stream was read, so a failure means the decisions are missing or cut short, and must not be cached
+            self.saveCachedSpeech(cacheKeys)
+        self.finishRun()
+
+    def startRun(self, sourceFile, primaryLevel, otherLevels):
+        self.sourceFile = sourceFile
+        self.primaryLevel = primaryLevel
+        levels = [primaryLevel] + [level for level in otherLevels if level != primaryLevel]
+        self.speechByLevel = {level: SpeechStore() for level in levels}
+        self.segmentsByLevel = {}
+        self.audioProcessor.speechDetected = self.speechByLevel[primaryLevel] #kept for code that reads the primary level's decisions from the audio processor
+        return levels
+
+    def finishRun(self):
+        self.audioProcessor.speechDetected = self.speechByLevel[self.primaryLevel] #loading from the cache replaces the stores
+        if self.exportSegments:
+            self.splitAudioIntoSegments()
+
+    def speechCacheKey(self, sourceFile, parameters):
+        if self.cache is None:
+            return None
+        return self.cache.key(sourceFile, "speech", parameters)
+
+    def loadCachedSpeech(self, cacheKeys):#cacheKeys is {level: key}. Returns True only if the speech decisions of every level were loaded from the cache
+        if self.cache is None:
+            return False
+        cachedArrays = {}
+        for level, cacheKey in cacheKeys.items():
+            cachedArrays[level] = self.cache.load(cacheKey, ("timestamps", "speaking"))
+            if cachedArrays[level] is None:
+                return False
+        for level, arrays in cachedArrays.items():
+            instruments.log(Verbosity.NORMAL, f"Loaded {len(arrays['timestamps'])} cached speech decisions for level {level}")
+            instruments.count("cachedSpeechDecisionsLoaded", len(arrays['timestamps']))
+            self.speechByLevel[level] = SpeechStore.fromArrays(arrays["timestamps"], arrays["speaking"])
+            segmenter = SpeechSegmenter(self.frameDurationMs, self.paddingDurationMs)
+            frameDuration = self.frameDurationMs / 1000.0
+            for timestamp, speaking in zip(arrays["timestamps"].tolist(), arrays["speaking"].tolist()):
+                segmenter.push(timestamp, frameDuration, speaking)
+            segmenter.finish()
+            self.segmentsByLevel[level] = segmenter.segments
+        return True
+
+    def saveCachedSpeech(self, cacheKeys):
+        if self.cache is None:
+            return
+        for level, cacheKey in cacheKeys.items():
+            speechDetected = self.speechByLevel[level]
+            self.cache.save(cacheKey, timestamps=speechDetected.timestamps, speaking=speechDetected.speaking)
+
+    def detectSpeech(self, frames, sample_rate, levels):
+        #---one pass over the frames, with each frame evaluated at every level
+        vads = [(level, webrtcvad.Vad(level), SpeechSegmenter(self.frameDurationMs, self.paddingDurationMs), self.speechByLevel[level]) for level in levels]
+        for frame in frames:
+            for level, vad, segmenter, speechDetected in vads:
+                is_speech = vad.is_speech(frame.bytes, sample_rate)
+                speechDetected.append(frame.timestamp, is_speech)
+                segmenter.push(frame.timestamp, frame.duration, is_speech)
+            instruments.count("vadCalls", len(vads))
+        for level, vad, segmenter, speechDetected in vads:
+            segmenter.finish()
+            self.segmentsByLevel[level] = segmenter.segments
+
+    def getSpeechDetectedSections(self, level=None):
+        return self.speechByLevel[self.primaryLevel if level is None else level]
+
+    def getSegments(self, level=None):#[(startSeconds, endSeconds)] of voiced audio
+        return self.segmentsByLevel[self.primaryLevel if level is None else level]
+
+    def splitAudioIntoSegments(self, level=None):
+        #---each segment is decoded again from the source, so no audio had to be kept around for this
+        for i, (startSeconds, endSeconds) in enumerate(self.getSegments(level)):
+            path = os.path.join(self.segmentDirectory, 'chunk-%002d.wav' % (i,))
+            instruments.log(Verbosity.DETAILED, ' Writing %s' % (path,))
+            process = self.audioProcessor.open_pcm_stream(self.sourceFile, self.sampleRate, startSeconds, endSeconds - startSeconds)
+            audio, _ = process.communicate()
+            self.audioProcessor.write_wave(path, audio, self.sampleRate)